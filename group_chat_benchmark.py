@@ -0,0 +1,541 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio Mastery Book - Group Chat Client and Server
+Chat server benchmarks
+"""
+
+import argparse
+import asyncio
+import functools
+import multiprocessing
+import os
+import ssl
+import subprocess
+import tempfile
+import time
+
+import group_chat_server as server
+from group_chat_load import percentile, start_server, stop_server
+from group_chat_protocol import DEFLATE, FRAMED, client_tls_context, encode_deflate
+
+#%%
+# =============================================================================
+# Simulated clients
+
+# The fan-out benchmark does not open real sockets. Each simulated client has a transport
+# that accepts every write, so the numbers only show the cost of the server side fan-out.
+# =============================================================================
+
+class SimulatedTransport():
+    # Constructor, count the bytes written
+    def __init__(self):
+        self.bytes_written = 0
+        
+    def write(self, data):
+        self.bytes_written += len(data)
+        
+    def is_closing(self):
+        return False
+    
+    def get_write_buffer_size(self):
+        return 0
+    
+    def get_write_buffer_limits(self):
+        return (16384, 65536)
+    
+class SimulatedWriter():
+    # Constructor, wrap a simulated transport like a StreamWriter
+    def __init__(self):
+        self.transport = SimulatedTransport()
+        
+    def write(self, data):
+        self.transport.write(data)
+        
+    async def drain(self):
+        pass
+    
+#%%
+# =============================================================================
+# Task per recipient broadcast
+
+# The original broadcast, kept here as the reference: one task per user for every message
+# =============================================================================
+
+async def write_message(writer, msg_bytes):
+    writer.write(msg_bytes)
+    await writer.drain()
+    
+async def task_per_user_broadcast(message, room):
+    msg_bytes = f"{message}\n".encode()
+    tasks = [asyncio.create_task(write_message(user.writer, msg_bytes))
+             for user in server.ROOMS[room]]
+    _ = await asyncio.wait(tasks)
+    
+# Fan-out broadcast from the server, wrapped in a coroutine so both can be timed the same way
+async def fan_out_broadcast(message, room):
+    server.broadcast_message(message, room)
+    
+#%%
+# =============================================================================
+# Fan-out benchmark
+
+# Broadcast messages to a room of simulated clients and report the tasks created per message
+# and the messages per second for each broadcast approach
+# =============================================================================
+
+async def run_fan_out(broadcast, n_clients, duration):
+    # Fill the room with simulated clients
+    server.ALL_USERS.clear()
+    server.ROOMS.clear()
+    for i in range(n_clients):
+        user = server.ChatUser(f"user{i}", None, SimulatedWriter())
+        server.ALL_USERS[user.id] = user
+        server.add_to_room(user, server.DEFAULT_ROOM)
+        
+    # Count every task created while broadcasting
+    loop = asyncio.get_running_loop()
+    tasks_created = 0
+    
+    def counting_task_factory(loop, coro, **kwargs):
+        nonlocal tasks_created
+        tasks_created += 1
+        return asyncio.Task(coro, loop=loop, **kwargs)
+    
+    loop.set_task_factory(counting_task_factory)
+    
+    # Broadcast messages until the duration has passed
+    n_messages = 0
+    time_start = time.perf_counter()
+    while time.perf_counter() - time_start < duration:
+        await broadcast(f"user0: message {n_messages}", server.DEFAULT_ROOM)
+        n_messages += 1
+    time_duration = time.perf_counter() - time_start
+    
+    loop.set_task_factory(None)
+    server.ALL_USERS.clear()
+    server.ROOMS.clear()
+    
+    return tasks_created / n_messages, n_messages / time_duration
+
+async def fan_out_benchmark(sizes, duration):
+    results = []
+    for n_clients in sizes:
+        for label, broadcast in (('task-per-user', task_per_user_broadcast),
+                                 ('fan-out', fan_out_broadcast)):
+            tasks_per_msg, msgs_per_sec = await run_fan_out(broadcast, n_clients, duration)
+            results.append((n_clients, label, tasks_per_msg, msgs_per_sec))
+    return results
+
+def report_fan_out(results):
+    print(f"{'clients':>8} {'broadcast':>14} {'tasks/msg':>10} {'msgs/sec':>10} {'writes/sec':>12}")
+    for n_clients, label, tasks_per_msg, msgs_per_sec in results:
+        print(f"{n_clients:>8} {label:>14} {tasks_per_msg:>10.0f} {msgs_per_sec:>10.1f} "
+              f"{msgs_per_sec * n_clients:>12.0f}")
+        
+#%%
+# =============================================================================
+# Multi-worker benchmark
+
+# Start the real server with a number of worker processes and connect real clients to it from
+# several load processes. Every client sends messages as fast as the server accepts them and
+# counts the messages it receives. The aggregate rate is the number of messages delivered to
+# all clients per second, until every client has received every message.
+# =============================================================================
+
+# Text that marks the benchmark messages in the stream
+BENCH_MARKER = b": bench-message"
+
+async def bench_client(port, name, n_messages, total_messages, start_at, timeout):
+    # Connect and join the chat
+    reader, writer = await asyncio.open_connection(server.HOST, port)
+    writer.write(f"{name}\n".encode())
+    await writer.drain()
+    
+    # Send the messages once every client is connected
+    async def send_messages():
+        await asyncio.sleep(start_at - time.time())
+        for _ in range(n_messages):
+            writer.write(BENCH_MARKER[2:] + b"\n")
+            await writer.drain()
+            
+    send_task = asyncio.create_task(send_messages())
+    
+    # Count the benchmark messages received, a marker may be split between two reads
+    received, tail = 0, b""
+    time_last = time.time()
+    deadline = start_at + timeout
+    while received < total_messages and time.time() < deadline:
+        try:
+            data = await asyncio.wait_for(reader.read(65536), deadline - time.time())
+        except asyncio.TimeoutError:
+            break
+        if not data:
+            break
+        data = tail + data
+        received += data.count(BENCH_MARKER)
+        tail = data[-len(BENCH_MARKER) + 1:]
+        time_last = time.time()
+        
+    await send_task
+    writer.close()
+    return received, time_last
+
+async def bench_clients(port, first, n_clients, n_messages, total_messages, start_at, timeout):
+    # Run a share of the clients in this load process
+    results = await asyncio.gather(*[
+        bench_client(port, f"bench{i}", n_messages, total_messages, start_at, timeout)
+        for i in range(first, first + n_clients)])
+    received = sum(result[0] for result in results)
+    return received, max(result[1] for result in results)
+
+def run_bench_clients(*args):
+    return asyncio.run(bench_clients(*args))
+
+def run_workers_benchmark(port, n_workers, n_clients, n_messages, n_processes, timeout):
+    # Start the chat server, with a queue large enough to never drop a benchmark message and
+    # no rate limit on the clients
+    process = start_server(port, '--workers', str(n_workers), '--queue-size', '1000000',
+                           '--rate-limit', '0')
+    try:
+        # Give each load process a share of the clients
+        shares = [n_clients // n_processes + (i < n_clients % n_processes)
+                  for i in range(n_processes)]
+        firsts = [sum(shares[:i]) for i in range(n_processes)]
+        total_messages = n_clients * n_messages
+        
+        # All clients start sending at the same time, once they are connected
+        start_at = time.time() + 1 + n_clients / 500
+        with multiprocessing.Pool(n_processes) as pool:
+            results = pool.starmap(run_bench_clients, [
+                (port, first, share, n_messages, total_messages, start_at, timeout)
+                for first, share in zip(firsts, shares)])
+    finally:
+        stop_server(process)
+        
+    delivered = sum(result[0] for result in results)
+    time_duration = max(result[1] for result in results) - start_at
+    return total_messages, delivered, total_messages * n_clients, time_duration
+
+def workers_benchmark(port, workers, n_clients, n_messages, n_processes, timeout):
+    print(f"{n_clients} clients sending {n_messages} messages each, "
+          f"{n_processes} load processes, {os.cpu_count()} cpus")
+    print(f"{'workers':>8} {'msgs/sec':>10} {'delivered/sec':>14} {'delivered':>12}")
+    for n_workers in workers:
+        sent, delivered, expected, time_duration = run_workers_benchmark(
+            port, n_workers, n_clients, n_messages, n_processes, timeout)
+        print(f"{n_workers:>8} {sent / time_duration:>10.1f} {delivered / time_duration:>14.0f} "
+              f"{delivered:>7}/{expected}")
+        
+#%%
+# =============================================================================
+# TLS benchmark
+
+# Start a plaintext and a TLS server, the TLS one with a self-signed certificate made by the
+# openssl command. Measure the connections per second, each one reading the banner of the
+# server, without TLS, with a full TLS handshake and with a resumed TLS session. Then measure
+# the throughput of one client sending messages to itself through its room.
+# =============================================================================
+
+def make_certificate(directory):
+    # Self-signed certificate for the local address, with a fast elliptic curve key
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec',
+                    '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+                    '-keyout', keyfile, '-out', certfile, '-days', '1', '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=IP:127.0.0.1,DNS:localhost'],
+                   check=True, capture_output=True)
+    return certfile, keyfile
+
+async def close_writer(writer):
+    # Close a connection, the server may still be sending its banner
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except (ConnectionError, ssl.SSLError):
+        pass
+    
+async def connection_rate(port, ssl_context, resume, n_connections):
+    # Open connections one after the other, return the rate and the resumed sessions
+    resumed = 0
+    time_start = time.perf_counter()
+    for _ in range(n_connections):
+        reader, writer = await asyncio.open_connection(server.HOST, port, ssl=ssl_context)
+        await reader.readline()
+        if ssl_context is not None:
+            resumed += writer.get_extra_info('ssl_object').session_reused
+            if resume:
+                ssl_context.remember(writer)
+        await close_writer(writer)
+    return n_connections / (time.perf_counter() - time_start), resumed
+
+async def throughput(open_stream, name, n_messages, message_size):
+    # Join the chat alone and send the messages to the room
+    reader, writer = await open_stream()
+    writer.write(f"{name}\n".encode())
+    message = BENCH_MARKER[2:] + b"x" * max(0, message_size - len(BENCH_MARKER)) + b"\n"
+    
+    async def send_messages():
+        for _ in range(n_messages):
+            writer.write(message)
+            await writer.drain()
+            
+    # Count the messages coming back, a marker may be split between two reads
+    time_start = time.perf_counter()
+    send_task = asyncio.create_task(send_messages())
+    received, tail, n_bytes = 0, b"", 0
+    while received < n_messages:
+        data = await reader.read(65536)
+        if not data:
+            break
+        n_bytes += len(data)
+        data = tail + data
+        received += data.count(BENCH_MARKER)
+        tail = data[-len(BENCH_MARKER) + 1:]
+    time_duration = time.perf_counter() - time_start
+    
+    await send_task
+    await close_writer(writer)
+    return received / time_duration, n_bytes / time_duration
+
+async def run_tls_benchmark(port, cafile, n_connections, n_messages, message_size):
+    results = []
+    for label, tls, resume in (('plaintext', False, False), ('tls', True, False),
+                               ('tls-resumed', True, True)):
+        ssl_context = client_tls_context(cafile) if tls else None
+        server_port = port + 1 if tls else port
+        
+        # Resume a session taken from a first connection
+        if resume:
+            await connection_rate(server_port, ssl_context, True, 1)
+        rate, resumed = await connection_rate(server_port, ssl_context, resume, n_connections)
+        open_stream = functools.partial(asyncio.open_connection, server.HOST, server_port,
+                                        ssl=ssl_context)
+        msgs_per_sec, bytes_per_sec = await throughput(open_stream, f"{label}-bench", n_messages,
+                                                       message_size)
+        results.append((label, rate, resumed, msgs_per_sec, bytes_per_sec))
+    return results
+
+def tls_benchmark(port, n_connections, n_messages, message_size):
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = make_certificate(directory)
+        
+        # Plaintext server on the port, TLS server on the next one
+        server_args = ('--rate-limit', '0', '--queue-size', '1000000', '--log-sample', '0')
+        plain_process = start_server(port, *server_args)
+        tls_process = start_server(port + 1, *server_args,
+                                   '--certfile', certfile, '--keyfile', keyfile)
+        try:
+            results = asyncio.run(run_tls_benchmark(port, certfile, n_connections, n_messages,
+                                                    message_size))
+        finally:
+            stop_server(plain_process)
+            stop_server(tls_process)
+            
+    print(f"{n_connections} connections, {n_messages} messages of {message_size} bytes")
+    print(f"{'mode':>12} {'conns/sec':>10} {'resumed':>8} {'msgs/sec':>10} {'MB/sec':>8}")
+    for label, rate, resumed, msgs_per_sec, bytes_per_sec in results:
+        print(f"{label:>12} {rate:>10.0f} {resumed:>8} {msgs_per_sec:>10.0f} "
+              f"{bytes_per_sec / 1e6:>8.1f}")
+        
+#%%
+# =============================================================================
+# Unix socket benchmark
+
+# Start the server listening on TCP and on a Unix socket, and compare both transports for a
+# client on the same host: the round trip latency of one message at a time sent to its own
+# room, then the throughput of many messages in flight.
+# =============================================================================
+
+async def round_trips(open_stream, name, n_round_trips):
+    # Join the chat alone and wait for the welcome message
+    reader, writer = await open_stream()
+    writer.write(f"{name}\n".encode())
+    while not (await reader.readline()).startswith(b"Welcome"):
+        pass
+    
+    # Send one message at a time and wait for it to come back
+    latencies = []
+    for _ in range(n_round_trips):
+        time_start = time.perf_counter()
+        writer.write(BENCH_MARKER[2:] + b"\n")
+        while BENCH_MARKER not in await reader.readline():
+            pass
+        latencies.append(time.perf_counter() - time_start)
+        
+    await close_writer(writer)
+    return sorted(latencies)
+
+async def run_unix_benchmark(port, unix_path, n_round_trips, n_messages, message_size):
+    results = []
+    for label, open_stream in (('tcp', functools.partial(asyncio.open_connection,
+                                                        server.HOST, port)),
+                               ('unix', functools.partial(asyncio.open_unix_connection,
+                                                          unix_path))):
+        latencies = await round_trips(open_stream, f"{label}-latency", n_round_trips)
+        msgs_per_sec, bytes_per_sec = await throughput(open_stream, f"{label}-throughput",
+                                                       n_messages, message_size)
+        results.append((label, latencies, msgs_per_sec, bytes_per_sec))
+    return results
+
+def unix_benchmark(port, n_round_trips, n_messages, message_size):
+    with tempfile.TemporaryDirectory() as directory:
+        unix_path = os.path.join(directory, 'chat.sock')
+        process = start_server(port, '--unix', unix_path, '--rate-limit', '0',
+                               '--queue-size', '1000000', '--log-sample', '0')
+        try:
+            results = asyncio.run(run_unix_benchmark(port, unix_path, n_round_trips, n_messages,
+                                                     message_size))
+        finally:
+            stop_server(process)
+            
+    print(f"{n_round_trips} round trips, {n_messages} messages of {message_size} bytes")
+    print(f"{'transport':>10} {'p50 ms':>8} {'p99 ms':>8} {'msgs/sec':>10} {'MB/sec':>8}")
+    for label, latencies, msgs_per_sec, bytes_per_sec in results:
+        print(f"{label:>10} {percentile(latencies, 0.5) * 1e3:>8.3f} "
+              f"{percentile(latencies, 0.99) * 1e3:>8.3f} {msgs_per_sec:>10.0f} "
+              f"{bytes_per_sec / 1e6:>8.1f}")
+        
+#%%
+# =============================================================================
+# Compression benchmark
+
+# Broadcast chat messages to rooms of simulated clients that all talk one codec, and report
+# the bytes written per delivered message and the CPU time per broadcast. Plain frames are
+# compared with compressed frames shared by every recipient and, as the reference, with the
+# message compressed again for each recipient like a per-connection context would need.
+# =============================================================================
+
+# Messages of the benchmark, typical chat lines
+CHAT_LINES = (
+    "hey everyone, has anyone seen the meeting notes from today?",
+    "I think they are on the wiki, let me check and get back to you",
+    "thanks! also the build is broken again on the main branch :(",
+    "yes I saw that, should be fixed in a few minutes",
+    "lol ok, I will wait for the fix before merging then",
+    "does anyone know when the next release is planned? the roadmap says next week",
+    "https://example.com/docs/release-notes has all the details about what changed",
+    "great, thank you for sharing that link",
+)
+
+# Compressed broadcast for each user, the way a per-connection context would work
+async def per_recipient_compression(message, room):
+    text_bytes = message.encode()
+    for user in server.ROOMS[room]:
+        user.send(memoryview(encode_deflate(text_bytes)))
+        
+async def run_compression(broadcast, codec, n_clients, n_messages):
+    # Fill the room with simulated clients of the codec
+    server.ALL_USERS.clear()
+    server.ROOMS.clear()
+    users = []
+    for i in range(n_clients):
+        user = server.ChatUser(f"user{i}", None, SimulatedWriter())
+        user.codec = codec
+        server.ALL_USERS[user.id] = user
+        server.add_to_room(user, server.DEFAULT_ROOM)
+        users.append(user)
+        
+    # Broadcast the chat lines in turn, counting the payload and the CPU time
+    payload_bytes = 0
+    time_start = time.process_time()
+    for i in range(n_messages):
+        message = f"user{i % n_clients}: {CHAT_LINES[i % len(CHAT_LINES)]}"
+        payload_bytes += len(message)
+        await broadcast(message, server.DEFAULT_ROOM)
+    time_cpu = time.process_time() - time_start
+    
+    bytes_written = sum(user.transport.bytes_written for user in users)
+    server.ALL_USERS.clear()
+    server.ROOMS.clear()
+    
+    return (bytes_written / (n_messages * n_clients), payload_bytes / n_messages,
+            time_cpu / n_messages)
+
+async def compression_benchmark(sizes, n_messages):
+    results = []
+    for n_clients in sizes:
+        for label, broadcast, codec in (('framed', fan_out_broadcast, FRAMED),
+                                        ('deflate', fan_out_broadcast, DEFLATE),
+                                        ('per-recipient', per_recipient_compression, DEFLATE)):
+            results.append((n_clients, label,
+                            *await run_compression(broadcast, codec, n_clients, n_messages)))
+    return results
+
+def report_compression(results, n_messages):
+    print(f"{n_messages} messages per room size")
+    print(f"{'clients':>8} {'frames':>14} {'bytes/msg':>10} {'ratio':>6} {'cpu us/msg':>11} "
+          f"{'MB/cpu sec':>11}")
+    for n_clients, label, bytes_per_msg, payload_per_msg, time_per_msg in results:
+        print(f"{n_clients:>8} {label:>14} {bytes_per_msg:>10.1f} "
+              f"{bytes_per_msg / payload_per_msg:>6.2f} {time_per_msg * 1e6:>11.1f} "
+              f"{bytes_per_msg * n_clients / time_per_msg / 1e6:>11.1f}")
+        
+#%%
+# =============================================================================
+# Run the benchmarks
+# =============================================================================
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Asyncio group chat server benchmarks")
+    parser.add_argument('benchmark', nargs='?', choices=('fan-out', 'workers', 'tls', 'unix', 'compression'),
+                        default='fan-out',
+                        help="benchmark to run")
+    
+    # Fan-out benchmark
+    parser.add_argument('--clients', type=int, nargs='+', default=None,
+                        help="fan-out, compression: simulated clients per run, 1000 and 10000 "
+                             "for fan-out, 10, 100 and 1000 for compression")
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help="fan-out: seconds to broadcast for in each run")
+    
+    # Multi-worker benchmark
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help="workers: server worker processes per run")
+    parser.add_argument('--load-clients', type=int, default=100,
+                        help="workers: connected clients")
+    parser.add_argument('--messages', type=int, default=20,
+                        help="workers: messages sent by each client")
+    parser.add_argument('--load-processes', type=int, default=os.cpu_count(),
+                        help="workers: processes running the clients")
+    parser.add_argument('--port', type=int, default=8890,
+                        help="workers, tls, unix: port of the benchmarked server, "
+                             "tls also uses the next one")
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help="workers: seconds to wait for all messages")
+    
+    # TLS benchmark
+    parser.add_argument('--connections', type=int, default=500,
+                        help="tls: connections opened in each mode")
+    parser.add_argument('--throughput-messages', type=int, default=20000,
+                        help="tls, unix: messages sent in each mode")
+    parser.add_argument('--message-size', type=int, default=200,
+                        help="tls, unix: bytes per message")
+    
+    # Unix socket benchmark
+    parser.add_argument('--round-trips', type=int, default=2000,
+                        help="unix: messages sent one at a time to measure the latency")
+    
+    # Compression benchmark
+    parser.add_argument('--broadcasts', type=int, default=2000,
+                        help="compression: messages broadcast to each room size")
+    return parser.parse_args()
+
+# Protect the entry point
+if __name__ == '__main__':
+    args = parse_args()
+    
+    if args.benchmark == 'fan-out':
+        results = asyncio.run(fan_out_benchmark(args.clients or [1000, 10000], args.duration))
+        report_fan_out(results)
+    elif args.benchmark == 'workers':
+        workers_benchmark(args.port, args.workers, args.load_clients, args.messages,
+                          args.load_processes, args.timeout)
+    elif args.benchmark == 'tls':
+        tls_benchmark(args.port, args.connections, args.throughput_messages, args.message_size)
+    elif args.benchmark == 'unix':
+        unix_benchmark(args.port, args.round_trips, args.throughput_messages, args.message_size)
+    else:
+        results = asyncio.run(compression_benchmark(args.clients or [10, 100, 1000],
+                                                    args.broadcasts))
+        report_compression(results, args.broadcasts)
@@ -7,53 +7,343 @@ Asyncio Mastery Book - Group Chat Client and Server
 Chat client code
 """
 
+import argparse
 import asyncio
+import os
+import random
+import ssl
+import stat
 import sys
 
+from group_chat_protocol import (DEFLATE, DEFLATE_OK, FRAMED, FRAMED_OK, FRAME_PING, FRAME_PONG,
+                                 FRAME_TEXT, LINE, NAME_TAKEN, PING, PROTO_DEFLATE, PROTO_FRAMED,
+                                 RESUME, TOKEN, FrameReader, client_tls_context, encode_heartbeat,
+                                 encode_message)
+
 #%%
 # =============================================================================
-# Read and transmit user messages
+# Connection to the server
+
+# The connection to the server can drop, when the server restarts for example. The client
+# then reconnects on its own after a random delay below a limit that doubles after every
+# failed attempt, up to a cap. Thousands of clients dropped at the same moment spread their
+# reconnections instead of all coming back at once.
+
+# The first line the user types is their name. The server answers with a resume token, and
+# a reconnection sends RESUME <token> <name> instead of the name, so the server puts the
+# user back in their room and replays the messages they missed. When the name is taken the
+# server asks for another one, and the next line the user types becomes their name.
 
-# Coroutine that reads messages and transmits to the chat server
+# With --compress the client asks for compressed frames, the server may answer that it only
+# sends plain frames. Every frame received is decompressed by the frame reader.
 # =============================================================================
 
-async def write_messages(writer):
-    while True:
-        # Read from the stdin
-        message = await asyncio.to_thread(sys.stdin.readline)
+# Limit of the first reconnection delay and largest limit, in seconds
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+
+class ChatConnection():
+    # Constructor, store how to reach the server. Compression implies the framed protocol.
+    def __init__(self, host, port, framed, idle_timeout, ssl_context=None, unix_path=None,
+                 compress=False):
+        self.host = host
+        self.port = port
+        self.framed = framed or compress
+        self.compress = compress
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl_context
+        self.unix_path = unix_path
         
-        # Encode the string message to bytes
-        msg_bytes = message.encode()
+        # Codec agreed with the server on the current connection
+        self.codec = LINE
         
-        # Transmit the message to the server
-        writer.write(msg_bytes)
+        # Name of the user and resume token, known once given
+        self.name = None
+        self.token = None
         
-        # Wait for the buffer to be empty
-        await writer.drain()
+        # Stream writer of the current connection, set while connected
+        self.writer = None
+        self.connected = asyncio.Event()
         
-        # Check if the user wants to quit the chat
-        if message.strip() == "QUIT":
-            break
+        # Set once the user has quit, the client then stops reconnecting
+        self.quitting = False
+        
+        # True until the server gives the resume token, only then are TOKEN and NAME TAKEN
+        # lines from the server and not chat messages
+        self.handshake = True
+    
+    # Open a connection, through the Unix socket of a server on the same host or with TLS
+    # when given a context, and give the name or the token again after a reconnection
+    async def open(self):
+        if self.unix_path is not None:
+            reader, writer = await asyncio.open_unix_connection(self.unix_path)
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port,
+                                                           ssl=self.ssl_context)
+        
+        # Ask for the framed protocol before sending the name, the server may refuse to
+        # compress and then the client does not either
+        if self.framed:
+            writer.write(f"{PROTO_DEFLATE if self.compress else PROTO_FRAMED}\n".encode())
+        self.codec = DEFLATE if self.compress else FRAMED if self.framed else LINE
+        self.writer = writer
+        self.handshake = True
+        if self.name is not None:
+            self.send(f"{RESUME} {self.token} {self.name}" if self.token else self.name)
+        return reader
+    
+    # Send a message to the server
+    def send(self, message):
+        self.send_lines([message])
+    
+    # Send several messages to the server in one write
+    def send_lines(self, messages):
+        # Encode the string messages to bytes
+        self.writer.write(b''.join(encode_message(message.rstrip('\n').encode(), self.codec)
+                                   for message in messages))
+    
+    # Close the current connection
+    async def close(self):
+        writer, self.writer = self.writer, None
+        self.connected.clear()
+        if writer is None:
+            return
+        
+        # Keep the TLS session to resume it on the next connection
+        if self.ssl_context is not None:
+            self.ssl_context.remember(writer)
         
+        # Wait for the connection to close, the server may still be sending
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass
+    
+    # Coroutine that keeps the client connected until the user quits
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            print(f"Connecting to {self.unix_path or f'{self.host}:{self.port}'}...")
+            try:
+                reader = await self.open()
+            except OSError as error:
+                print(f"Connection failed: {error}")
+            else:
+                print("Connected!")
+                self.connected.set()
+                time_connected = loop.time()
+                try:
+                    await read_messages(self, reader)
+                except ConnectionError:
+                    print("Connection to the server lost.")
+                await self.close()
+                
+                # Start the backoff again after a connection that lasted
+                if loop.time() - time_connected > BACKOFF_CAP:
+                    attempt = 0
+            
+            if self.quitting:
+                return
+            
+            # Wait a random delay below the limit of this attempt
+            delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+            attempt += 1
+            print(f"Reconnecting in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+
+#%%
+# =============================================================================
+# Read and transmit user messages
+
+# Coroutine that reads messages and transmits to the chat server.
+# With the framed protocol every line is sent as a text frame.
+# A line typed while the client is reconnecting waits for the connection. QUIT ends the
+# client at once if no line is waiting, the end of the input sends the waiting lines first.
+
+# By default each line of stdin is read in a worker thread. With --stdin-pipe stdin is
+# connected to the event loop as a pipe: every chunk read gives all the lines it holds, and
+# they go to the server in one write, so `cat big.txt | python group_chat_client.py
+# --stdin-pipe` sends as fast as the server accepts. Stdin that is not a pipe, a file or a
+# terminal, is still read in a thread. The end of the input sends QUIT.
+# =============================================================================
+
+class PipedInput():
+    # Constructor, wrap the stream reader connected to stdin
+    def __init__(self, reader):
+        self.reader = reader
+        
+        # Start of a line whose end has not been read yet
+        self.partial = b''
+    
+    # Return the complete lines read, an empty list at the end of the input
+    async def read_lines(self):
+        while True:
+            data = await self.reader.read(1 << 16)
+            if not data:
+                # Give the last line even without its newline
+                lines = [self.partial] if self.partial else []
+                self.partial = b''
+                return [line.decode() for line in lines]
+            
+            lines = (self.partial + data).split(b'\n')
+            self.partial = lines.pop()
+            if lines:
+                return [line.decode() for line in lines]
+
+async def connect_stdin():
+    # Connect stdin to a stream reader, None unless stdin is a pipe or a socket. Files and
+    # devices cannot be polled by the event loop and a terminal is better read in a thread.
+    mode = os.fstat(sys.stdin.fileno()).st_mode
+    if not (stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)):
+        return None
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    return PipedInput(reader)
+
+async def read_input(piped_input):
+    # Read the next lines from the pipe, or the next line in a worker thread
+    if piped_input is not None:
+        return await piped_input.read_lines()
+    message = await asyncio.to_thread(sys.stdin.readline)
+    return [message] if message else []
+
+async def write_messages(connection, piped_input=None):
+    # Lines read but not sent yet, the read in progress and the wait for a connection
+    messages = []
+    input_task = asyncio.create_task(read_input(piped_input))
+    connected_task = asyncio.create_task(connection.connected.wait())
+    try:
+        while True:
+            # Wait for more input, and for the connection when there are lines to send
+            waiting = [input_task] if input_task is not None else []
+            if messages:
+                waiting.append(connected_task)
+            await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            
+            # Read from the stdin, at the end of the input quit once the user has a name
+            if input_task is not None and input_task.done():
+                lines, input_task = input_task.result(), None
+                if not lines:
+                    if connection.name is None and not messages:
+                        break
+                    lines = ["QUIT"]
+                messages += lines
+                
+                # Keep reading until the user quits
+                if not any(message.strip() == "QUIT" for message in lines):
+                    input_task = asyncio.create_task(read_input(piped_input))
+            
+            # Check if the user wants to quit the chat, nothing after QUIT is sent
+            quit_at = next((i for i, message in enumerate(messages)
+                            if message.strip() == "QUIT"), None)
+            
+            # Quit at once while the server is unreachable and nothing else waits to be sent,
+            # otherwise wait for the connection
+            if not connection.connected.is_set():
+                if quit_at == 0:
+                    connection.quitting = True
+                    print("Quitting...")
+                    return False
+                if connected_task.done():
+                    connected_task = asyncio.create_task(connection.connected.wait())
+                continue
+            
+            # The first line is the name of the user
+            if connection.name is None:
+                connection.name = messages[0].strip()
+            if quit_at is not None:
+                messages = messages[:quit_at + 1]
+                connection.quitting = True
+            
+            # Transmit the messages to the server
+            connection.send_lines(messages)
+            messages = []
+            
+            # Wait for the buffer to be empty, a lost connection is handled by the reader
+            try:
+                await connection.writer.drain()
+            except ConnectionError:
+                pass
+            
+            if connection.quitting:
+                break
+    finally:
+        connected_task.cancel()
+    
     # Report the program is being terminated
+    connection.quitting = True
     print("Quitting...")
-    
+    return True
+
 #%%
 # =============================================================================
 # Read and report server messages
 
-# Coroutine that will read messages sent from the server and report them to the user
+# Coroutine that will read messages sent from the server and report them to the user.
+# The server sends a PING when the connection has been quiet, the client answers PONG at
+# once. It returns when the server closes the connection or has been silent for longer
+# than the idle timeout, the client then reconnects.
 # =============================================================================
 
-async def read_messages(reader):
-    while True:
-        # Read the message from the server
-        result_bytes = await reader.readline()
-        
-        # Decode and report the response
-        response = result_bytes.decode()
-        print(response.strip())
+async def read_messages(connection, reader):
+    try:
+        if connection.framed:
+            await read_frames(connection, reader)
+            return
         
+        while True:
+            # Read the message from the server, an empty result is the end of the stream
+            result_bytes = await asyncio.wait_for(reader.readline(), connection.idle_timeout)
+            if not result_bytes:
+                print("Connection to the server lost.")
+                return
+            
+            # Decode and report the response, answer the heartbeats
+            handle_response(connection, result_bytes.decode().strip(), LINE)
+    except asyncio.TimeoutError:
+        print("The server stopped responding.")
+
+async def read_frames(connection, reader):
+    # The server sends lines until it agrees to switch to frames, compressed or not
+    while True:
+        result_bytes = await asyncio.wait_for(reader.readline(), connection.idle_timeout)
+        response = result_bytes.decode().strip()
+        if not result_bytes or response in (FRAMED_OK, DEFLATE_OK):
+            break
+        print(response)
+    if response == FRAMED_OK:
+        connection.codec = FRAMED
+    
+    # Report every text frame, all the frames received are parsed at once
+    frame_reader = FrameReader(reader)
+    while True:
+        frames = await asyncio.wait_for(frame_reader.read_frames(), connection.idle_timeout)
+        if not frames:
+            print("Connection to the server lost.")
+            return
+        for frame_type, payload in frames:
+            if frame_type == FRAME_TEXT:
+                handle_response(connection, payload.decode(), connection.codec)
+            elif frame_type == FRAME_PING:
+                connection.writer.write(encode_heartbeat(FRAME_PONG, connection.codec))
+
+def handle_response(connection, response, codec):
+    # Answer a PING, keep the resume token, forget a name that was refused and report
+    # everything else. The token ends the handshake.
+    if response == PING:
+        connection.writer.write(encode_heartbeat(FRAME_PONG, codec))
+    elif connection.handshake and response.startswith(TOKEN + ' '):
+        connection.token = response[len(TOKEN) + 1:]
+        connection.handshake = False
+    elif connection.handshake and response.startswith(NAME_TAKEN + ' '):
+        connection.name = None
+        print(f"The name {response[len(NAME_TAKEN) + 1:]} is taken.")
+    else:
+        print(response)
+
 #%%
 # =============================================================================
 # Drive connection with server
@@ -61,40 +351,73 @@ async def read_messages(reader):
 # Manage both user actions and connection with the server
 # =============================================================================
 
-async def main():
-    # Define the server details
-    host, port = '127.0.0.1', 8887
-    
-    # Report progress to the user
-    print(f"Connecting to {host}:{port}...")
+async def main(host, port, framed, idle_timeout, ssl_context=None, unix_path=None,
+               stdin_pipe=False, compress=False):
     
-    # Open a connection to the server
-    reader, writer = await asyncio.open_connection(host, port)
+    # Keep a connection to the server, reading and reporting its messages
+    connection = ChatConnection(host, port, framed, idle_timeout, ssl_context, unix_path,
+                                compress)
+    run_task = asyncio.create_task(connection.run())
     
-    # Report progress to the user
-    print("Connected!")
-    
-    # Read and report messages from the server
-    read_task = asyncio.create_task(read_messages(reader))
-    
-    # Write messages to the server
-    await write_messages(writer)
-    
-    # Cancel the read messages task
-    read_task.cancel()
+    # Write messages to the server until the user quits or the input ends
+    piped_input = await connect_stdin() if stdin_pipe else None
+    connected = await write_messages(connection, piped_input)
     
     # Report progress to the user
     print("Disconnecting from the server...")
     
-    # Close the stream writer
-    writer.close()
-    
-    # Wait for the tcp connection to close
-    await writer.wait_closed()
+    # The server closes the connection after QUIT, once it has read every message before it.
+    # Closing first could reset the connection and lose them. Without a connection or a
+    # name there is nothing to wait for, stop reconnecting.
+    if connection.name is None or not connected:
+        run_task.cancel()
+    try:
+        await run_task
+    except asyncio.CancelledError:
+        pass
+    if connection.writer is not None:
+        await connection.close()
     
     # Report progress to the user
     print("Done.")
-    
+
 #%%
-# Run the event loop
-asyncio.run(main())
\ No newline at end of file
+# =============================================================================
+# Command line options
+# =============================================================================
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Asyncio group chat client")
+    parser.add_argument('--host', default='127.0.0.1', help="address of the chat server")
+    parser.add_argument('--port', type=int, default=8887, help="port of the chat server")
+    parser.add_argument('--unix', default=None,
+                        help="path of the Unix socket of a server on this host, instead of TCP")
+    parser.add_argument('--framed', action='store_true',
+                        help="use length-prefixed frames instead of lines")
+    parser.add_argument('--compress', action='store_true',
+                        help="ask for compressed frames, implies --framed")
+    parser.add_argument('--idle-timeout', type=float, default=120.0,
+                        help="seconds without a message or PING before the server is considered gone")
+    parser.add_argument('--max-backoff', type=float, default=BACKOFF_CAP,
+                        help="longest delay in seconds before reconnecting to the server")
+    parser.add_argument('--stdin-pipe', action='store_true',
+                        help="read stdin on the event loop, for input piped from another program")
+    parser.add_argument('--tls', action='store_true', help="connect with TLS")
+    parser.add_argument('--cafile', default=None,
+                        help="certificate trusted for TLS, the system certificates by default")
+    return parser.parse_args()
+
+#%%
+# Protect the entry point
+if __name__ == '__main__':
+    args = parse_args()
+    BACKOFF_CAP = args.max_backoff
+    
+    # Trust the given certificate, for example the self-signed one of a local server
+    ssl_context = None
+    if args.tls or args.cafile:
+        ssl_context = client_tls_context(args.cafile)
+    
+    # Run the event loop
+    asyncio.run(main(args.host, args.port, args.framed, args.idle_timeout, ssl_context,
+                     args.unix, args.stdin_pipe, args.compress))
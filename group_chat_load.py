@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio Mastery Book - Group Chat Client and Server
+Chat load generator
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from array import array
+
+from group_chat_protocol import (FRAMED, FRAMED_OK, FRAME_PING, FRAME_PONG, FRAME_TEXT, LINE, PING,
+                                 PROTO_FRAMED, FrameReader, encode_frame, encode_heartbeat)
+
+#%%
+# =============================================================================
+# Local chat server
+
+# By default the load generator starts its own chat server on a free local port, so it runs
+# without network access. --port connects to a server that is already running instead.
+# =============================================================================
+
+HOST = '127.0.0.1'
+
+def free_port():
+    # Ask the system for a port nobody is listening on
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+def start_server(port, *server_args):
+    # Start the chat server, its per message report goes nowhere
+    process = subprocess.Popen([sys.executable, 'group_chat_server.py',
+                                '--port', str(port), *server_args],
+                               cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL)
+    
+    # Wait for the server to accept connections
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((HOST, port)):
+                return process
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("the chat server did not start")
+
+def stop_server(process):
+    process.terminate()
+    process.wait()
+
+#%%
+# =============================================================================
+# Simulated client
+
+# Every simulated client joins the chat and records the latency of the load messages it
+# receives. A load message carries the time it was sent, as the senders and the receivers
+# live in this process they share the same clock.
+# =============================================================================
+
+# Text that starts every load message
+LOAD_MARKER = b"LOAD "
+
+class LoadClient():
+    # Constructor, store the streams and the latencies list shared by all clients
+    def __init__(self, name, reader, writer, framed, latencies):
+        self.name = name
+        self.reader = reader
+        self.writer = writer
+        self.framed = framed
+        self.latencies = latencies
+    
+    # Send a load message stamped with the current time
+    def send(self, seq):
+        text = LOAD_MARKER + f"{self.name} {seq} {time.perf_counter_ns()}".encode()
+        self.writer.write(encode_frame(text) if self.framed else text + b"\n")
+    
+    # Record the latency of one received message
+    def receive(self, text):
+        # Messages look like "name: LOAD sender seq time", skip anything else
+        _, marker, fields = text.partition(b": " + LOAD_MARKER)
+        fields = fields.split(b" ")
+        if not marker or len(fields) != 3 or \
+                not fields[1].isdigit() or not fields[2].isdigit():
+            return
+        self.latencies.append(time.perf_counter_ns() - int(fields[2]))
+    
+    # Coroutine receiving messages until the connection is closed
+    async def receive_messages(self):
+        if self.framed:
+            # Every complete frame received is parsed at once
+            frame_reader = FrameReader(self.reader)
+            while True:
+                frames = await frame_reader.read_frames()
+                if not frames:
+                    return
+                for frame_type, payload in frames:
+                    if frame_type == FRAME_TEXT:
+                        self.receive(payload)
+                    elif frame_type == FRAME_PING:
+                        self.writer.write(encode_heartbeat(FRAME_PONG, FRAMED))
+        
+        # Split the received bytes in lines, keeping the last partial line
+        partial = b""
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            lines = (partial + data).split(b"\n")
+            partial = lines.pop()
+            for line in lines:
+                # Answer the heartbeats so quiet clients are not closed
+                if line == PING.encode():
+                    self.writer.write(encode_heartbeat(FRAME_PONG, LINE))
+                else:
+                    self.receive(line)
+
+async def connect_client(port, name, framed, latencies, limit):
+    # Connect a few clients at a time so the listen backlog does not overflow
+    async with limit:
+        reader, writer = await asyncio.open_connection(HOST, port)
+        
+        # Ask for the framed protocol and skip the lines sent before the switch
+        if framed:
+            writer.write(f"{PROTO_FRAMED}\n".encode())
+            while True:
+                line = await reader.readline()
+                if not line or line.strip() == FRAMED_OK.encode():
+                    break
+            writer.write(encode_frame(name.encode()))
+        else:
+            writer.write(f"{name}\n".encode())
+        await writer.drain()
+    
+    return LoadClient(name, reader, writer, framed, latencies)
+
+#%%
+# =============================================================================
+# Load generation
+
+# A single coroutine paces all the senders: it wakes up, sends every message that is due
+# at the requested rate and picks the senders in turn. This costs the same whatever the
+# number of clients, and falls back to bursts if the loop is late.
+# =============================================================================
+
+async def send_load(senders, rate, duration):
+    interval = 1 / rate
+    sent = 0
+    time_start = time.perf_counter()
+    while True:
+        elapsed = time.perf_counter() - time_start
+        if elapsed >= duration:
+            break
+        
+        # Send all the messages due by now
+        due = int(elapsed / interval) + 1
+        while sent < due:
+            senders[sent % len(senders)].send(sent)
+            sent += 1
+        
+        # Sleep until the next message is due
+        await asyncio.sleep(max(0, sent * interval - (time.perf_counter() - time_start)))
+    return sent, time.perf_counter() - time_start
+
+async def run_load(port, n_clients, n_senders, rate, duration, framed, settle):
+    # Latencies in nanoseconds of every message received by every client
+    latencies = array('q')
+    
+    # Connect all the clients
+    limit = asyncio.Semaphore(100)
+    clients = await asyncio.gather(*[connect_client(port, f"load{i}", framed, latencies, limit)
+                                     for i in range(n_clients)])
+    receive_tasks = [asyncio.create_task(client.receive_messages()) for client in clients]
+    
+    # Let the connection announcements pass before measuring
+    await asyncio.sleep(settle)
+    
+    # Send the load and wait for the last messages to arrive
+    sent, time_duration = await send_load(clients[:n_senders], rate, duration)
+    await asyncio.sleep(settle)
+    
+    # Disconnect the clients
+    for client in clients:
+        client.writer.close()
+    await asyncio.gather(*receive_tasks, return_exceptions=True)
+    
+    return sent, time_duration, latencies
+
+#%%
+# =============================================================================
+# Report
+# =============================================================================
+
+def percentile(ordered, fraction):
+    # Value below which the fraction of the ordered values falls
+    if not ordered:
+        return float('nan')
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def report(n_clients, sent, time_duration, latencies):
+    ordered = sorted(latencies)
+    expected = sent * n_clients
+    print(f"clients:      {n_clients}")
+    print(f"sent:         {sent} messages, {sent / time_duration:.1f} msgs/sec")
+    print(f"delivered:    {len(ordered)} of {expected}, {len(ordered) / time_duration:.0f} msgs/sec")
+    for label, fraction in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999), ('max', 1.0)):
+        print(f"latency {label + ':':5} {percentile(ordered, fraction) / 1e6:.3f} ms")
+
+#%%
+# =============================================================================
+# Run the load generator
+# =============================================================================
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Asyncio group chat load generator")
+    parser.add_argument('--clients', type=int, default=1000, help="simulated clients")
+    parser.add_argument('--senders', type=int, default=None,
+                        help="clients sending messages, all of them by default")
+    parser.add_argument('--rate', type=float, default=100.0,
+                        help="messages sent per second by all the senders together")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of load")
+    parser.add_argument('--framed', action='store_true', help="use the framed protocol")
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help="seconds to wait before and after the load")
+    parser.add_argument('--port', type=int, default=None,
+                        help="port of a running chat server, by default a local one is started")
+    parser.add_argument('--server-args', default='',
+                        help="extra options for the chat server that is started, which runs "
+                             "with --rate-limit 0 unless they set it")
+    return parser.parse_args()
+
+# Protect the entry point
+if __name__ == '__main__':
+    args = parse_args()
+    n_senders = min(args.senders or args.clients, args.clients)
+    
+    # Start a local chat server unless one was given, without the per-user rate limit so
+    # the load measures the server. --server-args '--rate-limit 20' puts it back.
+    port, process = args.port, None
+    if port is None:
+        port = free_port()
+        process = start_server(port, '--rate-limit', '0', *args.server_args.split())
+    
+    try:
+        sent, time_duration, latencies = asyncio.run(run_load(
+            port, args.clients, n_senders, args.rate, args.duration, args.framed, args.settle))
+    finally:
+        if process is not None:
+            stop_server(process)
+    
+    report(args.clients, sent, time_duration, latencies)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio Mastery Book - Group Chat Client and Server
+Runtime metrics in the Prometheus text format
+"""
+
+import asyncio
+import bisect
+import time
+
+#%%
+# =============================================================================
+# Metrics
+
+# Counters and histograms are plain numbers updated in place, the hot path never formats or
+# writes anything. Metrics that can be computed from the state of the server, like the
+# number of connected users, take a function called only when the metrics are scraped.
+# =============================================================================
+
+class Counter():
+    # Constructor, a counter is either increased in place or computed by collect()
+    def __init__(self, name, help, collect=None):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.value = 0
+    
+    # Increase the counter
+    def inc(self, amount=1):
+        self.value += amount
+    
+    # Lines of the counter in the text format
+    def render(self):
+        value = self.value if self.collect is None else self.collect()
+        return [f"# HELP {self.name} {self.help}",
+                f"# TYPE {self.name} counter",
+                f"{self.name} {value}"]
+
+class Gauge():
+    # Constructor, the value of a gauge is computed by collect() when scraped
+    def __init__(self, name, help, collect):
+        self.name = name
+        self.help = help
+        self.collect = collect
+    
+    # Lines of the gauge in the text format
+    def render(self):
+        return [f"# HELP {self.name} {self.help}",
+                f"# TYPE {self.name} gauge",
+                f"{self.name} {self.collect()}"]
+
+class Histogram():
+    # Constructor, store the upper bounds of the buckets. A histogram given collect() is
+    # filled from the values it returns every time it is scraped.
+    def __init__(self, name, help, buckets, collect=None):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self.collect = collect
+        self.reset()
+    
+    # Forget every observation
+    def reset(self):
+        # The last count is for the values above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+    
+    # Count a value in its bucket
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    # Lines of the histogram in the text format, the bucket counts are cumulative
+    def render(self):
+        if self.collect is not None:
+            self.reset()
+            for value in self.collect():
+                self.observe(value)
+        
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} histogram"]
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+def exponential_buckets(start, factor, count):
+    # Bucket bounds growing by a factor, for latencies and sizes
+    return [start * factor ** i for i in range(count)]
+
+class Registry():
+    # Constructor, no metric yet
+    def __init__(self):
+        self.metrics = []
+    
+    # Add a metric and return it
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+    
+    # Every metric in the text format
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+#%%
+# =============================================================================
+# Event loop lag
+
+# A coroutine sleeps for a fixed interval and measures how late it wakes up. Anything that
+# blocks the event loop shows up as lag.
+# =============================================================================
+
+async def monitor_loop_lag(histogram, interval=0.1):
+    while True:
+        time_start = time.perf_counter()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, time.perf_counter() - time_start - interval))
+
+#%%
+# =============================================================================
+# Admin endpoint
+
+# A minimal HTTP server answering every request with the metrics, enough for Prometheus or
+# curl. It listens on its own port, local by default, away from the chat clients.
+# =============================================================================
+
+async def serve_metrics(registry, host, port):
+    # Coroutine answering one scrape
+    async def handle_scrape(reader, writer):
+        try:
+            # Skip the request up to the blank line ending its headers
+            while True:
+                line = await reader.readline()
+                if not line or line in (b'\r\n', b'\n'):
+                    break
+            
+            body = registry.render().encode()
+            writer.write(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: text/plain; version=0.0.4\r\n"
+                         + f"Content-Length: {len(body)}\r\n".encode()
+                         + b"Connection: close\r\n\r\n" + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+    
+    return await asyncio.start_server(handle_scrape, host, port)
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio Mastery Book - Group Chat Client and Server
+Chat protocol shared by the server and the client
+"""
+
+import ssl
+import struct
+import zlib
+
+#%%
+# =============================================================================
+# Protocol negotiation
+
+# By default the chat is line based: every message is a line of text ending with a newline.
+# A client can ask for the framed protocol by sending the PROTO_FRAMED line before its name.
+# The server answers with the FRAMED_OK line and from then on both sides send frames.
+# A client asking for PROTO_DEFLATE also wants compressed frames. The server answers
+# DEFLATE_OK if it agrees, or FRAMED_OK for plain frames if it does not.
+# =============================================================================
+
+# Codecs a user can talk
+LINE = 'line'
+FRAMED = 'framed'
+DEFLATE = 'deflate'
+
+# Lines used to switch to the framed protocol, with or without compression
+PROTO_FRAMED = 'PROTO FRAMED'
+FRAMED_OK = 'PROTO FRAMED OK'
+PROTO_DEFLATE = 'PROTO FRAMED DEFLATE'
+DEFLATE_OK = 'PROTO FRAMED DEFLATE OK'
+
+# Heartbeat lines, the server sends PING to an idle client which answers PONG
+PING = 'PING'
+PONG = 'PONG'
+
+# Line sent before asking again for a name that is already taken: NAME TAKEN <name>
+NAME_TAKEN = 'NAME TAKEN'
+
+# Session resumption, the server gives each user a TOKEN line and a reconnecting client sends
+# RESUME <token> <name> instead of its name
+TOKEN = 'TOKEN'
+RESUME = 'RESUME'
+
+#%%
+# =============================================================================
+# Frames
+
+# A frame is a header with a type byte and the size of the payload, followed by the payload.
+# The payload of a text frame is UTF-8 text without a trailing newline, so it can hold
+# several lines.
+# =============================================================================
+
+FRAME_HEADER = struct.Struct('!BI')
+
+# Frame types, the heartbeat frames have no payload
+FRAME_TEXT = 1
+FRAME_PING = 2
+FRAME_PONG = 3
+FRAME_DEFLATE = 4
+
+# Largest payload accepted from the other side
+MAX_FRAME_SIZE = 1 << 20
+
+# Bytes requested from the stream on each read
+READ_SIZE = 1 << 16
+
+def encode_frame(payload, frame_type=FRAME_TEXT):
+    # Prefix the payload with its header
+    return FRAME_HEADER.pack(frame_type, len(payload)) + payload
+
+def encode_heartbeat(frame_type, codec):
+    # Encode a PING or PONG for a codec
+    if codec != LINE:
+        return encode_frame(b'', frame_type)
+    return (PING if frame_type == FRAME_PING else PONG).encode() + b'\n'
+
+def encode_message(text_bytes, codec):
+    # Encode the text of a message for a codec
+    if codec == FRAMED:
+        return encode_frame(text_bytes)
+    if codec == DEFLATE:
+        return encode_deflate(text_bytes)
+    return text_bytes + b'\n'
+
+class FrameError(Exception):
+    # Raised when the other side sends a frame that is too large
+    pass
+
+#%%
+# =============================================================================
+# Compression
+
+# Every compressed frame is deflated on its own, with no state carried from one frame to the
+# next. A streaming context per connection would compress better, but the server would then
+# have to compress each broadcast once per recipient. Stateless frames are compressed once
+# and the same bytes go to every user of the codec. To make up for the lost context both
+# sides start from a preset dictionary of the text that chat messages usually contain.
+
+# Chat messages are short, so a small window is enough and costs far less to set up for
+# every frame. The dictionary has to fit in the window, the most frequent strings come last.
+# A frame that would not shrink is sent as a plain text frame.
+# =============================================================================
+
+DEFLATE_DICTIONARY = (
+    b"http://https://www..com/.org/ :) :( lol thanks thank you please sorry yes no ok okay "
+    b"what when where which would could should about there their they think know just "
+    b"like from have with this that your you are the and for not but can will one all "
+    b"was has been also into then than more some time good great today tomorrow meeting "
+    b"JOIN LEAVE QUIT Send JOIN <room> to change room, LEAVE to return to #lobby and QUIT "
+    b"to disconnect. You are in #lobby. Welcome back Server restarting, please reconnect. "
+    b"Server shutting down. has left # has left the room has joined # has reconnected! "
+    b"has connected! : ")
+
+# Window of 2**10 bytes and small internal state, raw deflate without header or checksum
+DEFLATE_WBITS = -10
+DEFLATE_MEMLEVEL = 5
+DEFLATE_LEVEL = 6
+
+def encode_deflate(text_bytes):
+    # Compress the text into a deflate frame, or a text frame if it does not get smaller
+    compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, DEFLATE_WBITS, DEFLATE_MEMLEVEL,
+                                  zlib.Z_DEFAULT_STRATEGY, DEFLATE_DICTIONARY)
+    payload = compressor.compress(text_bytes) + compressor.flush()
+    if len(payload) < len(text_bytes):
+        return encode_frame(payload, FRAME_DEFLATE)
+    return encode_frame(text_bytes)
+
+def inflate_payload(payload):
+    # Decompress the payload of a deflate frame, refusing more than MAX_FRAME_SIZE bytes
+    decompressor = zlib.decompressobj(DEFLATE_WBITS, zdict=DEFLATE_DICTIONARY)
+    try:
+        text_bytes = decompressor.decompress(payload, MAX_FRAME_SIZE)
+    except zlib.error as error:
+        raise FrameError(f"bad compressed frame: {error}") from None
+    if decompressor.unconsumed_tail:
+        raise FrameError("compressed frame is too large")
+    return text_bytes
+
+#%%
+# =============================================================================
+# Frame reader
+
+# Read big chunks from the stream and parse every complete frame in the buffer at once,
+# instead of awaiting the stream once per header and once per payload.
+# Deflate frames are decompressed on the way, they come out as text frames.
+# =============================================================================
+
+class FrameReader():
+    # Constructor, wrap a stream reader
+    def __init__(self, reader):
+        self.reader = reader
+        self.buffer = bytearray()
+        
+        # Frames parsed but not returned yet
+        self.pending = []
+        
+        # Bytes read from the stream, compressed frames count their size on the wire
+        self.bytes_read = 0
+    
+    # Return the next (type, payload) frame, None at the end of the stream
+    async def read_frame(self):
+        frames = await self.read_frames()
+        if not frames:
+            return None
+        
+        # Keep the other frames for the next read
+        self.pending = frames[1:]
+        return frames[0]
+    
+    # Return the list of the next (type, payload) frames, an empty list at the end of the stream
+    async def read_frames(self):
+        # Return the frames left over by read_frame() first
+        if self.pending:
+            frames, self.pending = self.pending, []
+            return frames
+        
+        while True:
+            # Parse the frames already received
+            frames = self.parse_frames()
+            if frames:
+                return frames
+            
+            # Wait for more data
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                return []
+            self.bytes_read += len(data)
+            self.buffer += data
+    
+    # Take all the complete frames out of the buffer
+    def parse_frames(self):
+        frames = []
+        offset = 0
+        buffer = self.buffer
+        with memoryview(buffer) as view:
+            while len(buffer) - offset >= FRAME_HEADER.size:
+                # Read the header, stop if the payload has not arrived yet
+                frame_type, size = FRAME_HEADER.unpack_from(buffer, offset)
+                if size > MAX_FRAME_SIZE:
+                    raise FrameError(f"frame of {size} bytes is too large")
+                start = offset + FRAME_HEADER.size
+                end = start + size
+                if end > len(buffer):
+                    break
+                
+                # Copy the payload out of the buffer
+                if frame_type == FRAME_DEFLATE:
+                    frames.append((FRAME_TEXT, inflate_payload(view[start:end])))
+                else:
+                    frames.append((frame_type, bytes(view[start:end])))
+                offset = end
+        
+        # Drop the parsed frames from the buffer
+        del buffer[:offset]
+        return frames
+
+#%%
+# =============================================================================
+# TLS
+
+# The server and the client can talk over TLS. Resuming a session skips the certificate
+# exchange and the key agreement, so a storm of reconnecting clients costs the server far
+# less. The server side needs nothing more: OpenSSL hands out session tickets and keeps a
+# session cache by default. The client has to offer the session of its last connection,
+# but asyncio wraps the socket itself and has no session argument, so the client context
+# passes its remembered session to every SSLObject it creates.
+# =============================================================================
+
+def server_tls_context(certfile, keyfile=None):
+    # Context of the server, with its certificate and private key
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+class ResumingContext(ssl.SSLContext):
+    # Session offered to the server on the next connection
+    session = None
+    
+    # Called by asyncio for each connection, offer the remembered session
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.session
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+    
+    # Remember the session of a connection. With TLS 1.3 the ticket comes after the
+    # handshake, so call this once the server has sent something.
+    def remember(self, writer):
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object is not None and ssl_object.session is not None:
+            self.session = ssl_object.session
+            
+def client_tls_context(cafile=None):
+    # Context of the client, trusting cafile or the system certificates
+    context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    if cafile is not None:
+        context.load_verify_locations(cafile)
+    else:
+        context.load_default_certs()
+    return context
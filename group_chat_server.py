@@ -8,85 +8,1298 @@ Asyncio Mastery Book - Group Chat Client and Server
 Chat server code
 """
 
+import argparse
 import asyncio
+import itertools
+import json
+import logging
+import logging.handlers
+import math
+import mmap
+import multiprocessing
+import os
+import queue
+import secrets
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from collections import OrderedDict, deque
+
+from group_chat_metrics import (Counter, Gauge, Histogram, Registry, exponential_buckets,
+                                monitor_loop_lag, serve_metrics)
+from group_chat_protocol import (DEFLATE, DEFLATE_OK, FRAMED, FRAMED_OK, FRAME_PING, FRAME_TEXT, LINE,
+                                 NAME_TAKEN, PONG, PROTO_DEFLATE, PROTO_FRAMED, RESUME, TOKEN,
+                                 FrameError, FrameReader, encode_heartbeat, encode_message,
+                                 server_tls_context)
+
+#%%
+# =============================================================================
+# Server settings
+
+# Each user gets a bounded outbound queue. When a client stops reading and its queue fills
+# up, the slow client policy decides what happens:
+# - drop-oldest: discard the oldest queued message to make room for the new one
+# - drop-newest: discard the new message and keep the queued ones
+# - disconnect: close the slow client's connection
+# =============================================================================
+
+# Dictionary of all connected users, connection id -> ChatUser
+ALL_USERS = {}
+
+# Index of the connected users by name, name in lower case -> ChatUser
+NAMES = {}
+
+# Source of the connection ids
+CONNECTION_IDS = itertools.count(1)
+
+# Names a client may try before the connection is closed
+NAME_ATTEMPTS = 3
+
+# Index of the members of every room, room name -> set of ChatUser
+ROOMS = {}
+
+# Room every user starts in and returns to on LEAVE
+DEFAULT_ROOM = 'lobby'
+
+# Slow client policies
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+DISCONNECT = 'disconnect'
+SLOW_CLIENT_POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+# Maximum number of messages waiting to be sent to a single user
+QUEUE_SIZE = 256
+
+# What to do with a user whose queue is full
+SLOW_CLIENT_POLICY = DROP_OLDEST
+
+# Address the chat clients connect to
+HOST, PORT = '127.0.0.1', 8887
+
+# TLS context of the server, None to serve plaintext
+SSL_CONTEXT = None
+
+# Whether clients of the framed protocol may ask for compressed frames
+COMPRESSION = True
+
+# Listening Unix socket for the clients on the same host, None to only listen on TCP
+UNIX_SOCKET = None
+
+# Listening TCP sockets inherited from the process that handed over, None to create them
+INHERITED_SOCKETS = None
+
+# Seconds over which the users are disconnected on shutdown, and longest wait for their
+# messages to be written before the connections are dropped
+DRAIN_SPREAD = 1.0
+DRAIN_TIMEOUT = 10.0
+
+# Set once the server is shutting down, and once it has handed its sockets to a new process
+DRAINING = False
+HANDED_OFF = False
+
+# Stream to the message bus and number of the worker when running as one of several
+# workers, None otherwise
+BUS_WRITER = None
+WORKER_ID = None
+
+# Coalescing window joining the messages of each user into one write, None to write each
+# message as it is broadcast
+COALESCER = None
+
+# Chat history of the rooms, room name -> RoomHistory, least recently used first
+HISTORIES = OrderedDict()
+
+# Limits of the chat history: messages and payload bytes kept per room, rooms with a history
+# and messages replayed to a user entering a room
+HISTORY_SIZE = 100
+HISTORY_BYTES = 64 * 1024
+HISTORY_ROOMS = 1000
+HISTORY_REPLAY = 20
+
+# Seconds between two status reports
+REPORT_INTERVAL = 60
+
+# Seconds during which the presence changes of a room are collected into one announcement,
+# and most names listed in it
+PRESENCE_DELAY = 0.1
+PRESENCE_NAMES = 10
+
+# Write-ahead log of the chat messages, None when the messages are not persisted
+WAL = None
+
+# Directory of the log segments, None to disable persistence
+WAL_DIR = None
+
+# Seconds between two group commits, size of a log segment and number of segments kept
+WAL_INTERVAL = 0.05
+WAL_SEGMENT_BYTES = 16 * 1024 * 1024
+WAL_SEGMENTS = 8
+
+# Timing wheel watching the idle connections, None when idle connections are kept forever
+WHEEL = None
+
+# Seconds of silence before a user is sent a PING and before the connection is closed
+PING_INTERVAL = 30
+IDLE_TIMEOUT = 90
+
+# Sessions of the users that left, resume token -> Session, oldest first
+SESSIONS = OrderedDict()
+
+# Seconds a session can be resumed after its user left, and most sessions kept
+RESUME_TTL = 300
+RESUME_SESSIONS = 10000
+
+# Messages per second and burst allowed to each user, 0 to disable the limit
+RATE_LIMIT = 20
+RATE_BURST = 40
+
+# Server-wide budget of messages written to recipients per second, None to disable it
+FANOUT_BUDGET = None
+
+# Number of times a user was paused by the limits
+THROTTLED = 0
+
+# Local address of the metrics endpoint, no endpoint when the port is None. Worker N listens
+# on ADMIN_PORT + N.
+ADMIN_HOST, ADMIN_PORT = '127.0.0.1', None
+
+# Log one broadcast in LOG_SAMPLE, 0 to log none
+LOG_SAMPLE = 1
+LOG = logging.getLogger('group_chat_server')
 
 #%%
 # =============================================================================
-# Broadcast to all clients
+# Connected user
 
-# Coroutine that sends concurrently a message to all connected clients on the group chat
+# Broadcasting hands the same bytes object straight to the transport of every user, there is
+# no task or coroutine per recipient. Only a user whose socket buffer is above the high-water
+# mark gets its messages queued, and a writer task is started for that user alone to wait on
+# drain() and empty the queue. A client with a full socket buffer only delays itself.
 # =============================================================================
 
-async def broadcast_message(message):
-    # Report locally
-    print(f"Broadcast: {message.strip()}")
+class ChatUser():
+    # Constructor, store the streams and the transport used by the fast path.
+    # Users of the framed protocol come with the frame reader used to read their name, and
+    # say whether they agreed on compressed frames.
+    def __init__(self, name, reader, writer, frame_reader=None, compress=False):
+        self.id = next(CONNECTION_IDS)
+        self.name = name
+        self.reader = reader
+        self.writer = writer
+        self.transport = writer.transport
+        self.frame_reader = frame_reader
+        if frame_reader is None:
+            self.codec = LINE
+        else:
+            self.codec = DEFLATE if compress else FRAMED
+        
+        # Room the user is currently in
+        self.room = None
+        
+        # Above this many buffered bytes the user is considered behind
+        _, self.high_water = self.transport.get_write_buffer_limits()
+        
+        # Messages waiting to be written to this user
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+        
+        # Number of messages discarded because the user fell behind
+        self.dropped = 0
+        
+        # Task emptying the queue, only running while the user is behind
+        self.task = None
+        
+        # Messages waiting for the end of the coalescing window
+        self.pending = []
+        
+        # Time the user was last heard from and time of the last PING sent
+        self.last_seen = time.monotonic()
+        self.pinged = 0.0
+        
+        # Messages the user may still send right away, None without a rate limit
+        self.bucket = TokenBucket(RATE_LIMIT, RATE_BURST) if RATE_LIMIT > 0 else None
+        
+        # Bytes read from and given to the connection
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        
+        # Token the client gives back to resume its session after a reconnection, and
+        # whether the user asked to leave for good
+        self.token = secrets.token_urlsafe(12)
+        self.quit = False
+        
+        # Done once the server closes the connection, it ends a throttle pause early
+        self.closed = asyncio.get_running_loop().create_future()
+        
+    # Read the next messages of the user, None at the end of the stream
+    async def read_lines(self):
+        if self.codec == LINE:
+            # One line at a time
+            line_bytes = await self.reader.readline()
+            if not line_bytes:
+                return None
+            self.last_seen = time.monotonic()
+            self.bytes_received += len(line_bytes)
+            return [line_bytes.decode().strip()]
+        
+        # Every complete frame already received, a PONG frame only counts as activity
+        bytes_read = self.frame_reader.bytes_read
+        frames = await self.frame_reader.read_frames()
+        if not frames:
+            return None
+        self.last_seen = time.monotonic()
+        self.bytes_received += self.frame_reader.bytes_read - bytes_read
+        return [payload.decode().strip() for frame_type, payload in frames
+                if frame_type == FRAME_TEXT]
     
-    # Parse the message into bytes
-    msg_bytes = message.encode()
+    # Called by the timing wheel, return when to check the user again or None once closed
+    def check_idle(self, now):
+        idle = now - self.last_seen
+        if idle >= IDLE_TIMEOUT:
+            # Silent for too long, the reader will see the end of the stream
+            self.transport.abort()
+            return None
+        if idle >= PING_INTERVAL:
+            # Ask for a sign of life once per silence
+            if self.pinged < self.last_seen:
+                self.send(encode_heartbeat(FRAME_PING, self.codec))
+                self.pinged = now
+            return self.last_seen + IDLE_TIMEOUT
+        return self.last_seen + PING_INTERVAL
+    
+    # Send a text to this user only
+    def send_text(self, text):
+        self.send(memoryview(encode_message(text.encode(), self.codec)))
+        
+    # Send an encoded message to this user without blocking
+    def send(self, msg_bytes):
+        # Nothing to do once the connection is closing
+        if self.transport.is_closing():
+            return
+        self.bytes_sent += len(msg_bytes)
+        
+        # Fast path, nothing queued and room in the socket buffer
+        if self.queue.empty() and self.transport.get_write_buffer_size() < self.high_water:
+            if COALESCER is None:
+                self.transport.write(msg_bytes)
+            else:
+                COALESCER.add(self, msg_bytes)
+            return
+        
+        # Slow path, keep the order by writing the messages of the coalescing window first
+        # and queueing behind the messages already queued
+        self.flush()
+        try:
+            self.queue.put_nowait(msg_bytes)
+        except asyncio.QueueFull:
+            self.fall_behind(msg_bytes)
+            
+        # Make sure a writer task is emptying the queue
+        if self.task is None:
+            self.task = asyncio.create_task(self.write_messages(), name=f"writer-{self.name}")
+            
+    # Write the messages of the coalescing window in one call
+    def flush(self):
+        if self.pending and not self.transport.is_closing():
+            self.transport.writelines(self.pending)
+        self.pending = []
+        
+    # Apply the slow client policy when the queue is full
+    def fall_behind(self, msg_bytes):
+        if SLOW_CLIENT_POLICY == DROP_OLDEST:
+            # Make room by discarding the oldest message
+            self.queue.get_nowait()
+            self.queue.put_nowait(msg_bytes)
+            self.dropped += 1
+        elif SLOW_CLIENT_POLICY == DROP_NEWEST:
+            # Discard the new message
+            self.dropped += 1
+        else:
+            # Drop the connection, the reader will see the end of the stream
+            self.transport.abort()
+            
+    # Coroutine that writes the queued messages to the user until the queue is empty
+    async def write_messages(self):
+        try:
+            while not self.queue.empty():
+                # Wait for the buffer to drop below the high-water mark
+                await self.writer.drain()
+                
+                # Write as many queued messages as fit below the high-water mark in one call
+                batch = []
+                room = self.high_water - self.transport.get_write_buffer_size()
+                while not self.queue.empty() and (not batch or room > 0):
+                    msg_bytes = self.queue.get_nowait()
+                    batch.append(msg_bytes)
+                    room -= len(msg_bytes)
+                self.writer.writelines(batch)
+        except ConnectionError:
+            # The connection is gone, the reader will clean up
+            pass
+        finally:
+            # The user has caught up
+            self.task = None
+        
+#%%
+# =============================================================================
+# Coalescing window
+
+# With --coalesce-messages N, a message sent on the fast path waits in the user's pending
+# list instead of being written at once. When the window closes every user with pending
+# messages gets them in one writelines() call, so a busy room costs one write per user per
+# window instead of one per message. A user reaching N pending messages is written at once.
+
+# The window adapts to the load. While each window only carries one message per user the
+# flush runs as soon as the event loop is free, so an idle room keeps its latency. When the
+# windows start to carry several messages the delay doubles, up to --coalesce-delay
+# microseconds, and it falls back to zero as soon as the traffic calms down.
+# =============================================================================
+
+class WriteCoalescer():
+    # Constructor, store the limits of the window
+    def __init__(self, max_messages, max_delay):
+        self.max_messages = max_messages
+        self.max_delay = max_delay
+        
+        # Users with pending messages
+        self.users = set()
+        
+        # Most messages a user got in the current window
+        self.busiest = 0
+        
+        # Delay of the next window in seconds and the scheduled flush
+        self.delay = 0.0
+        self.handle = None
+        
+    # Add a message to the window of a user
+    def add(self, user, msg_bytes):
+        self.users.add(user)
+        user.pending.append(msg_bytes)
+        if len(user.pending) > self.busiest:
+            self.busiest = len(user.pending)
+            
+        # A full window is written right away
+        if len(user.pending) >= self.max_messages:
+            user.flush()
+            
+        # Open a window if none is running
+        if self.handle is None:
+            loop = asyncio.get_running_loop()
+            if self.delay:
+                self.handle = loop.call_later(self.delay, self.flush)
+            else:
+                self.handle = loop.call_soon(self.flush)
+                
+    # Close the window and write the pending messages of every user in one call each
+    def flush(self):
+        self.handle = None
+        users, self.users = self.users, set()
+        for user in users:
+            user.flush()
+            
+        # Grow the window under load, go back to immediate flushes when idle
+        if self.busiest > 1:
+            self.delay = min(self.max_delay, max(self.delay * 2, self.max_delay / 16))
+        else:
+            self.delay = 0.0
+        self.busiest = 0
+        
+#%%
+# =============================================================================
+# Idle connections
+
+# A client that vanished without closing its connection, a pulled cable or a crashed NAT,
+# would hold its user forever. A single timing wheel watches every connection instead of a
+# timer per client: the wheel is a ring of slots of one tick each, an entry sits in the slot
+# of its next deadline and each tick only looks at the entries of one slot. Reading from a
+# user only stores the time, so a busy connection costs nothing until its deadline comes.
+
+# When the deadline of a user comes and it has been silent for PING_INTERVAL seconds it is
+# sent a PING, any message or the PONG answer counts as a sign of life. After IDLE_TIMEOUT
+# seconds of silence the connection is closed. Connections that have not given their name
+# yet are closed after IDLE_TIMEOUT seconds.
+# =============================================================================
+
+class TimingWheel():
+    # Constructor, create enough slots of tick seconds to hold the longest delay
+    def __init__(self, tick, longest):
+        self.tick = tick
+        self.slots = [set() for _ in range(math.ceil(longest / tick) + 2)]
+        
+        # Slot of every entry, and the slot of the current tick
+        self.slot_of = {}
+        self.position = 0
+        
+    # Schedule the check of an entry, the entry is a ChatUser or a PendingConnection
+    def schedule(self, entry, deadline):
+        self.cancel(entry)
+        ticks = math.ceil((deadline - time.monotonic()) / self.tick)
+        ticks = min(max(ticks, 1), len(self.slots) - 1)
+        slot = (self.position + ticks) % len(self.slots)
+        self.slots[slot].add(entry)
+        self.slot_of[entry] = slot
+        
+    # Stop watching an entry
+    def cancel(self, entry):
+        slot = self.slot_of.pop(entry, None)
+        if slot is not None:
+            self.slots[slot].discard(entry)
+            
+    # Coroutine turning the wheel one slot per tick
+    async def run(self):
+        next_tick = time.monotonic()
+        while True:
+            next_tick += self.tick
+            await asyncio.sleep(max(0, next_tick - time.monotonic()))
+            
+            # Take the entries of the slot, checking them may schedule them again
+            self.position = (self.position + 1) % len(self.slots)
+            due, self.slots[self.position] = self.slots[self.position], set()
+            now = time.monotonic()
+            for entry in due:
+                del self.slot_of[entry]
+                deadline = entry.check_idle(now)
+                if deadline is not None:
+                    self.schedule(entry, deadline)
+                    
+class PendingConnection():
+    # Constructor, a connection that has not given its name yet
+    def __init__(self, writer):
+        self.transport = writer.transport
+        
+    # Called by the timing wheel, the client took too long to give its name
+    def check_idle(self, now):
+        self.transport.abort()
+        return None
+    
+#%%
+# =============================================================================
+# Flood protection
+
+# Every chat line becomes one write per member of the room, so a single client sending as
+# fast as its socket allows would cost the server N writes per line. Two token buckets
+# bound that: one per user, spending a token per line, and one for the whole server,
+# spending a token per recipient of each line, the room for a broadcast and the two ends of
+# a direct message.
+
+# A bucket may go into debt, so a broadcast to a room larger than the burst still goes out.
+# The reader of the user then sleeps until the debt is paid instead of reading the next
+# line. While it sleeps the socket buffers fill up and TCP pushes back on the sender, the
+# server does not hold any more of its messages. The user bucket only stops the flooding
+# user, a quiet user pays for its own line and goes on. The fan-out budget is one bucket for
+# the whole server: once a flood puts it into debt, every user who sends a line waits until
+# the debt is paid, quiet users included.
+# =============================================================================
+
+class TokenBucket():
+    # Constructor, start with a full bucket
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        
+    # Spend tokens and return the seconds to wait until the bucket is out of debt
+    def take(self, amount):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+    
+def throttle(user, recipients):
+    # Charge a line to the user and its recipients to the server, return the pause needed
+    delay = 0.0
+    if user.bucket is not None:
+        delay = user.bucket.take(1)
+    if FANOUT_BUDGET is not None:
+        delay = max(delay, FANOUT_BUDGET.take(recipients))
+    return delay
+
+#%%
+# =============================================================================
+# Rooms
+
+# Every user is in exactly one room. The room index maps each room to its members, so a
+# message is only written to the users of that room and the cost of a broadcast depends on
+# the size of the room, not on the number of connections. Empty rooms are removed.
+# =============================================================================
+
+def add_to_room(user, room):
+    # Create the room on first use and add the user to its members
+    ROOMS.setdefault(room, set()).add(user)
+    user.room = room
+    drop_snapshots(room)
+    
+def remove_from_room(user):
+    # Remove the user from the members of its room
+    members = ROOMS[user.room]
+    members.discard(user)
+    drop_snapshots(user.room)
     
-    # Enumerate all users and broadcast the message
-    global ALL_USERS
+    # Forget the room once the last user has left
+    if not members:
+        del ROOMS[user.room]
+    user.room = None
     
-    # Concurrent approach
-    # Create a task for each write to client
-    tasks = [asyncio.create_task(write_message(writer, msg_bytes))
-             for _, (_, writer) in ALL_USERS.items()]
+def change_room(user, room):
+    # Nothing to do if the user is already there
+    if room == user.room:
+        return
     
-    # Wait for all writes to complete
-    _ = await asyncio.wait(tasks)
+    # Leave the current room and tell the users that stay
+    old_room = user.room
+    remove_from_room(user)
+    announce_presence(user.name, old_room, f"left #{old_room}")
     
-    # Sequential approach (slower)
-    # for _, (_, writer) in ALL_USERS.items():
-    #     # Write the message to the selected user
-    #     writer.write(msg_bytes)
+    # Enter the new room, catch up on its history and tell its users, including the one joining
+    add_to_room(user, room)
+    replay_history(user)
+    announce_presence(user.name, room, f"joined #{room}")
+    
+#%%
+# =============================================================================
+# Presence
+
+# Users are registered under their connection id, and the name index only points at the
+# connection that owns the name, so a second client can never take over or remove the entry
+# of the first. Names are unique regardless of case, with --workers N within each worker.
+
+# WHO lists the users of the room of the user and LIST the rooms with their sizes. Both
+# answers are encoded once per codec and kept until the members of a room change, so a
+# client polling them costs a lookup.
+
+# Joins and departures are not broadcast one by one. The changes of each room are collected
+# for PRESENCE_DELAY seconds and announced in a single message, so a burst of connections
+# costs one broadcast instead of one per user. A chat message sent to the room first flushes
+# the pending changes, so the announcements keep their order with the messages.
+# =============================================================================
+
+# Encoded WHO and LIST answers, (room, codec) -> bytes, with None as the room of LIST
+SNAPSHOTS = {}
+
+# Presence changes not announced yet, room -> {change -> list of names}
+PENDING_PRESENCE = {}
+
+# Timer announcing the pending presence changes, None when nothing is pending
+PRESENCE_TIMER = None
+
+def name_key(name):
+    # Key of a name in the index, names differing only by case are the same
+    return name.casefold()
+
+def register_user(user):
+    # Add a connected user to the index of connections and to the name index
+    ALL_USERS[user.id] = user
+    NAMES[name_key(user.name)] = user
+    
+def unregister_user(user):
+    # Remove a user from the indexes, the name only if it belongs to this connection
+    del ALL_USERS[user.id]
+    if NAMES.get(name_key(user.name)) is user:
+        del NAMES[name_key(user.name)]
         
-    #     # Wait for the buffer to be empty
-    #     await writer.drain()
+def send_snapshot(user, room):
+    # Send the users of a room, or the rooms when room is None, encoded on first use
+    key = (room, user.codec)
+    snapshot = SNAPSHOTS.get(key)
+    if snapshot is None:
+        if room is None:
+            text = "Rooms: " + ", ".join(f"#{name} ({len(members)})"
+                                         for name, members in sorted(ROOMS.items()))
+        else:
+            text = f"Users in #{room}: " + ", ".join(sorted(member.name
+                                                            for member in ROOMS.get(room, ())))
+        snapshot = SNAPSHOTS[key] = memoryview(encode_message(text.encode(), user.codec))
+    user.send(snapshot)
+    
+def drop_snapshots(room):
+    # Forget the answers that list the members of a room, LIST shows its size
+    for codec in (LINE, FRAMED, DEFLATE):
+        SNAPSHOTS.pop((room, codec), None)
+        SNAPSHOTS.pop((None, codec), None)
+        
+def announce_presence(name, room, change):
+    # Collect a change like "connected!" or "left #room" for the next announcement
+    global PRESENCE_TIMER
+    PENDING_PRESENCE.setdefault(room, {}).setdefault(change, []).append(name)
+    if PRESENCE_TIMER is None:
+        PRESENCE_TIMER = asyncio.get_running_loop().call_later(PRESENCE_DELAY, flush_presence)
+        
+def flush_presence():
+    # Announce the pending changes of every room
+    global PRESENCE_TIMER
+    PRESENCE_TIMER = None
+    for room in list(PENDING_PRESENCE):
+        flush_room_presence(room)
+        
+def flush_room_presence(room):
+    # Announce the pending changes of a room in one message, one line per change
+    changes = PENDING_PRESENCE.pop(room, None)
+    if not changes:
+        return
+    lines = []
+    for change, names in changes.items():
+        shown = ", ".join(names[:PRESENCE_NAMES])
+        if len(names) > PRESENCE_NAMES:
+            shown += f" and {len(names) - PRESENCE_NAMES} others"
+        lines.append(f"{shown} {'has' if len(names) == 1 else 'have'} {change}")
+    broadcast_message('\n'.join(lines), room)
     
 #%%
 # =============================================================================
-# Coroutine to transmit a message concurrently to all users
+# Room history
+
+# Each room keeps its last chat messages in a fixed size ring buffer. The messages are stored
+# as the UTF-8 bytes that were broadcast, so a replay only frames them and joins them into one
+# write for the codec of the user, nothing is decoded. A message is deflated on its first
+# replay to a compressing user and the frame is kept with the message, the following users
+# get the same bytes. Every message gets the next sequence number of its room, a resumed
+# session replays the messages after the last one its user had been sent.
+
+# Memory is bounded three ways: messages per room, payload bytes per room and number of rooms
+# with a history. The history of the least recently active room is dropped first. A deflated
+# frame is dropped with its message.
 # =============================================================================
 
-async def write_message(writer, msg_bytes):
-    # Write the message to the user
-    writer.write(msg_bytes)
+class RoomHistory():
+    # Constructor, create the ring buffer of (sequence number, message) pairs
+    def __init__(self, max_messages, max_bytes):
+        self.messages = deque(maxlen=max_messages)
+        self.max_bytes = max_bytes
+        
+        # Payload bytes in the buffer and sequence number of the last message
+        self.size = 0
+        self.last_seq = 0
+        
+        # Deflated frames of the messages already replayed to a compressing user, by sequence
+        # number
+        self.deflated = {}
+        
+    # Add a message, dropping the oldest ones when the buffer is full. Return its sequence
+    # number, the next one unless the message comes from the log with its own.
+    def append(self, text_bytes, seq=None):
+        self.last_seq = self.last_seq + 1 if seq is None else seq
+        
+        # A history of size 0 keeps no message, only the sequence numbers
+        if not self.messages.maxlen:
+            return self.last_seq
+        if len(self.messages) == self.messages.maxlen:
+            self.forget(self.messages[0])
+        self.messages.append((self.last_seq, text_bytes))
+        self.size += len(text_bytes)
+        
+        # Stay below the byte limit
+        while self.size > self.max_bytes:
+            self.forget(self.messages.popleft())
+        return self.last_seq
     
-    # Wait for the buffer to empty
-    await writer.drain()
+    # Account for a message leaving the buffer
+    def forget(self, message):
+        message_seq, text_bytes = message
+        self.size -= len(text_bytes)
+        self.deflated.pop(message_seq, None)
+        
+    # Encode the last messages for a codec in a single bytes object
+    def replay(self, count, codec):
+        first = max(0, len(self.messages) - count)
+        recent = itertools.islice(self.messages, first, None)
+        if codec == DEFLATE:
+            return b''.join(self.deflate(message_seq, text_bytes)
+                            for message_seq, text_bytes in recent)
+        return b''.join(encode_message(text_bytes, codec) for _, text_bytes in recent)
+    
+    # Deflate a message once, the following replays reuse its frame
+    def deflate(self, message_seq, text_bytes):
+        frame = self.deflated.get(message_seq)
+        if frame is None:
+            frame = self.deflated[message_seq] = encode_message(text_bytes, DEFLATE)
+        return frame
     
+    # Encode the messages after a sequence number for a codec, as far as the buffer goes
+    def replay_since(self, seq, codec):
+        missed = 0
+        for message_seq, _ in reversed(self.messages):
+            if message_seq <= seq:
+                break
+            missed += 1
+        return self.replay(missed, codec)
+    
+def record_message(text_bytes, room, seq=None):
+    # Find the history of the room and mark it as the most recently used
+    history = HISTORIES.get(room)
+    if history is None:
+        history = HISTORIES[room] = RoomHistory(HISTORY_SIZE, HISTORY_BYTES)
+        
+        # Forget the least recently used history above the limit
+        if len(HISTORIES) > HISTORY_ROOMS:
+            HISTORIES.popitem(last=False)
+    else:
+        HISTORIES.move_to_end(room)
+        
+    return history.append(text_bytes, seq)
+    
+def replay_history(user, since=None):
+    # Send the last messages of the room to a user who just entered it in one write, or the
+    # messages after a sequence number to a user resuming its session
+    history = HISTORIES.get(user.room)
+    if history is None:
+        return
+    if since is not None and since <= history.last_seq:
+        recent = history.replay_since(since, user.codec)
+    else:
+        recent = history.replay(HISTORY_REPLAY, user.codec) if HISTORY_REPLAY > 0 else b''
+    if recent:
+        user.send(memoryview(recent))
+        
+def last_seq(room):
+    # Sequence number of the last message of a room, 0 without a history
+    history = HISTORIES.get(room)
+    return history.last_seq if history is not None else 0
+            
+def history_memory():
+    # Number of messages and payload bytes held by all the histories
+    messages = sum(len(history.messages) for history in HISTORIES.values())
+    size = sum(history.size for history in HISTORIES.values())
+    return messages, size
+
+#%%
+# =============================================================================
+# Write-ahead log
+
+# With --wal-dir every chat message is appended to a log on disk. Appending only adds the
+# record to the current batch in memory, so broadcasting does not wait for the disk. A
+# background task commits the batch every --wal-interval milliseconds: the records are
+# written and fsynced in a worker thread, off the event loop, and the next batch fills up in
+# the meantime.
+
+# The log is split in segment files. A new segment is started when the current one is full,
+# a restart carries on with the last segment while it has room, and only the last segments
+# are kept. On start the
+# segments are memory-mapped and replayed into the room histories. A record is a header with
+# a CRC32, the size of the message and the size of the room name, followed by the sequence
+# number of the message in its room, the room name and the message. Replaying a segment
+# stops at the first incomplete or damaged record.
+# =============================================================================
+
+WAL_HEADER = struct.Struct('!IIH')
+WAL_SEQ = struct.Struct('!Q')
+
+def segment_paths(wal_dir):
+    # Segment files of the log, oldest first
+    names = sorted(name for name in os.listdir(wal_dir)
+                   if name.startswith('wal-') and name.endswith('.log'))
+    return [os.path.join(wal_dir, name) for name in names]
+
+def read_segment(path):
+    # Return the (sequence number, room, message) records of a segment and the size of the
+    # part holding them
+    records = []
+    offset = 0
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return records, offset
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            while offset + WAL_HEADER.size <= len(data):
+                crc, msg_size, room_size = WAL_HEADER.unpack_from(data, offset)
+                start = offset + WAL_HEADER.size
+                end = start + WAL_SEQ.size + room_size + msg_size
+                if end > len(data) or zlib.crc32(data[start:end]) != crc:
+                    break
+                seq, = WAL_SEQ.unpack_from(data, start)
+                room_start = start + WAL_SEQ.size
+                room = data[room_start:room_start + room_size].decode()
+                records.append((seq, room, data[room_start + room_size:end]))
+                offset = end
+    return records, offset
+
+def load_history(wal_dir):
+    # Rebuild the room histories from the log, return the number of messages read
+    count = 0
+    for path in segment_paths(wal_dir):
+        records, _ = read_segment(path)
+        for seq, room, text_bytes in records:
+            record_message(text_bytes, room, seq)
+            count += 1
+    return count
+
+class WriteAheadLog():
+    # Constructor, open the last segment or a new one after it
+    def __init__(self, wal_dir, interval, segment_bytes, segments):
+        self.wal_dir = wal_dir
+        self.interval = interval
+        self.segment_bytes = segment_bytes
+        self.segments = segments
+        
+        # Records waiting for the next group commit
+        self.batch = []
+        
+        # Open the segment, only the commit thread writes to it. Carry on with the last one
+        # while it has room, after its last complete record: a record cut short by a crash
+        # would hide the following ones from the replay.
+        paths = segment_paths(wal_dir)
+        number = int(os.path.basename(paths[-1])[4:-4]) if paths else 0
+        if paths and os.path.getsize(paths[-1]) < segment_bytes:
+            _, size = read_segment(paths[-1])
+            os.truncate(paths[-1], size)
+        elif paths:
+            number += 1
+        self.open_segment(number)
+        
+        # Task committing the batches, and the lock that lets one commit run at a time
+        self.task = None
+        self.lock = asyncio.Lock()
+        
+    # Start the segment with this number and drop the oldest segments
+    def open_segment(self, number):
+        self.number = number
+        self.file = open(os.path.join(self.wal_dir, f"wal-{number:08d}.log"), 'ab')
+        for path in segment_paths(self.wal_dir)[:-self.segments]:
+            os.unlink(path)
+            
+    # Add a message to the next commit, this never blocks
+    def append(self, text_bytes, room, seq):
+        room_bytes = room.encode()
+        body = WAL_SEQ.pack(seq) + room_bytes + text_bytes
+        self.batch.append(WAL_HEADER.pack(zlib.crc32(body), len(text_bytes), len(room_bytes)))
+        self.batch.append(body)
+        
+    # Write and fsync a batch, run in a worker thread
+    def write_batch(self, batch):
+        self.file.write(b''.join(batch))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        
+        # Move on to a new segment when this one is full
+        if self.file.tell() >= self.segment_bytes:
+            self.file.close()
+            self.open_segment(self.number + 1)
+            
+    # Write the current batch, if any. One commit at a time writes to the segment.
+    async def commit(self):
+        async with self.lock:
+            if not self.batch:
+                return
+            batch, self.batch = self.batch, []
+            write = asyncio.ensure_future(asyncio.to_thread(self.write_batch, batch))
+            try:
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                # The thread cannot be stopped, keep the lock until it is done
+                await write
+                raise
+            
+    # Coroutine that commits the batches at a regular interval
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.commit()
+            
+    # Start the commit task
+    def start(self):
+        self.task = asyncio.create_task(self.run(), name="wal")
+        
+    # Commit what is left and close the segment
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await self.commit()
+        self.file.close()
+        
+#%%
+# =============================================================================
+# Broadcast to a room
+
+# Send a message to all the users in a room of the group chat.
+# The message is encoded once per codec and the same object is given to every user of that
+# codec, this never blocks. A compressed message is compressed once, whatever the number of
+# users who asked for compression.
+# When the server runs several workers the message is also published on the bus, so the
+# users connected to the other workers get it too.
+# Chat messages are recorded in the history of the room, notices like joins are not.
+# =============================================================================
+
+def broadcast_message(message, room, record=False):
+    # Announce the presence changes of the room before the message
+    if room in PENDING_PRESENCE:
+        flush_room_presence(room)
+        
+    # Report a sample of the broadcasts, the log is written by another thread
+    if LOG_SAMPLE and next(LOG_COUNTER) % LOG_SAMPLE == 0:
+        LOG.info("Broadcast #%s: %s", room, message)
+    
+    # Parse the message into bytes
+    text_bytes = message.encode()
+    
+    # Send the message to the users of this process
+    deliver_message(text_bytes, room, record)
+    
+    # Relay the message to the other workers
+    if BUS_WRITER is not None:
+        publish_message(text_bytes, room, BUS_RECORD if record else BUS_BROADCAST)
+        
+def deliver_message(text_bytes, room, record=False):
+    # Keep chat messages in the history of the room and in the log
+    if record:
+        seq = record_message(text_bytes, room)
+        if WAL is not None:
+            WAL.append(text_bytes, room, seq)
+        
+    # Enumerate the users of the room and send the message
+    time_start = time.perf_counter()
+    send_encoded(text_bytes, ROOMS.get(room, ()))
+    BROADCAST_SECONDS.observe(time.perf_counter() - time_start)
+    
+def send_encoded(text_bytes, users):
+    # Encoded message for each codec, made on first use
+    encoded = {}
+    for user in users:
+        msg_view = encoded.get(user.codec)
+        if msg_view is None:
+            # The memoryview avoids copies on partial socket writes
+            msg_view = memoryview(encode_message(text_bytes, user.codec))
+            encoded[user.codec] = msg_view
+        user.send(msg_view)
+        
+#%%
+# =============================================================================
+# Targeted delivery
+
+# A message for a few users is written to their connections alone, found through the
+# connection ids or the name index, so its cost does not depend on the size of any room.
+# MSG <name> <text>, or /msg, sends a direct message: the recipient and the sender get it,
+# nobody else does. When the server runs several workers a recipient that is not connected
+# to this worker is looked up by the others through the message bus.
+# Direct messages are not kept in any history.
+# =============================================================================
+
+def send_to_users(message, user_ids):
+    # Send a message to the connections of the given ids, encoded once per codec.
+    # Return the number of users it was sent to.
+    users = [ALL_USERS[user_id] for user_id in set(user_ids) if user_id in ALL_USERS]
+    send_encoded(message.encode(), users)
+    return len(users)
+
+def deliver_direct(text_bytes, name):
+    # Send a message to the user of this process with the name, return whether there is one
+    recipient = NAMES.get(name_key(name))
+    if recipient is None:
+        return False
+    recipient.send(memoryview(encode_message(text_bytes, recipient.codec)))
+    return True
+
+def send_direct(user, name, text):
+    # Send a direct message to the user with the name and echo it to the sender, return
+    # the number of recipients written to
+    recipient = NAMES.get(name_key(name))
+    if recipient is not None:
+        return send_to_users(prefix_lines(f"[{user.name} -> {recipient.name}] ", text),
+                             (user.id, recipient.id))
+    
+    # The recipient may be connected to another worker, no worker answers if there is none
+    message = prefix_lines(f"[{user.name} -> {name}] ", text)
+    if BUS_WRITER is not None:
+        publish_message(message.encode(), name, BUS_DIRECT)
+        user.send_text(f"{message} (sent to the other workers, delivery not confirmed)")
+        return 2
+    user.send_text(f"There is no user named {name}.")
+    return 1
+        
+#%%
+# =============================================================================
+# Message bus between workers
+
+# With --workers N the server forks N processes that all listen on the same port with
+# SO_REUSEPORT, the kernel spreads the connections among them. Each worker only knows its own
+# users, so every broadcast is also written to a Unix socket bus. The parent process relays
+# each bus message to all the other workers, which deliver it to their local users.
+
+# A bus message is a header with the kind of message, the size of the target and the size
+# of the message, followed by the target and the message bytes. The target is the room of a
+# broadcast, with or without recording it in the history, the name of the recipient of a
+# direct message or the resume token of a session kept or taken.
+
+# A worker writes to the bus directly while its socket buffer stays below the high-water
+# mark. Past it the messages wait in a bounded queue emptied by a task, as for a slow user,
+# and the worker stops reading its users until the bus has caught up. When the queue is
+# full the oldest message is dropped, or the new one with --slow-policy drop-newest.
+# =============================================================================
+
+BUS_HEADER = struct.Struct('!BHI')
+
+# Kinds of bus messages
+BUS_BROADCAST = 0
+BUS_RECORD = 1
+BUS_DIRECT = 2
+BUS_SESSION = 3
+BUS_SESSION_TAKEN = 4
+
+# Streams to every connected worker, only used in the parent process
+BUS_WORKERS = set()
+
+# Bus messages waiting while the bus is behind, the task writing them and the number of
+# messages dropped because the queue was full
+BUS_QUEUE_SIZE = 4096
+BUS_QUEUE = deque()
+BUS_TASK = None
+BUS_DROPPED = 0
+
+def publish_message(msg_bytes, target, kind):
+    # Write the message to the bus without waiting while the bus keeps up
+    global BUS_TASK, BUS_DROPPED
+    target_bytes = target.encode()
+    parts = (BUS_HEADER.pack(kind, len(target_bytes), len(msg_bytes)), target_bytes, msg_bytes)
+    transport = BUS_WRITER.transport
+    if not BUS_QUEUE and \
+            transport.get_write_buffer_size() < transport.get_write_buffer_limits()[1]:
+        BUS_WRITER.writelines(parts)
+        return
+    
+    # The bus is behind, queue the message and make sure a task is writing the queue
+    if len(BUS_QUEUE) >= BUS_QUEUE_SIZE:
+        BUS_DROPPED += 1
+        if SLOW_CLIENT_POLICY == DROP_NEWEST:
+            return
+        BUS_QUEUE.popleft()
+    BUS_QUEUE.append(parts)
+    if BUS_TASK is None:
+        BUS_TASK = asyncio.create_task(write_bus(), name="bus-writer")
+        
+async def write_bus():
+    # Write the queued bus messages until the queue is empty
+    global BUS_TASK
+    transport = BUS_WRITER.transport
+    try:
+        while BUS_QUEUE:
+            # Wait for the buffer to drop below the high-water mark
+            await BUS_WRITER.drain()
+            
+            # Write as many queued messages as fit below the high-water mark in one call
+            batch = []
+            room = transport.get_write_buffer_limits()[1] - transport.get_write_buffer_size()
+            while BUS_QUEUE and (not batch or room > 0):
+                parts = BUS_QUEUE.popleft()
+                batch.extend(parts)
+                room -= sum(len(part) for part in parts)
+            BUS_WRITER.writelines(batch)
+    except ConnectionError:
+        # The bus is gone, read_bus reports it
+        BUS_QUEUE.clear()
+    finally:
+        BUS_TASK = None
+    
+async def read_bus(reader):
+    # Deliver the messages published by the other workers to the local users
+    try:
+        while True:
+            header = await reader.readexactly(BUS_HEADER.size)
+            kind, target_size, msg_size = BUS_HEADER.unpack(header)
+            target = (await reader.readexactly(target_size)).decode()
+            msg_bytes = await reader.readexactly(msg_size)
+            if kind == BUS_DIRECT:
+                deliver_direct(msg_bytes, target)
+            elif kind == BUS_SESSION:
+                store_session(target, tuple(json.loads(msg_bytes)))
+            elif kind == BUS_SESSION_TAKEN:
+                SESSIONS.pop(target, None)
+            else:
+                deliver_message(msg_bytes, target, kind == BUS_RECORD)
+    except asyncio.IncompleteReadError:
+        print("Message bus closed")
+        
+async def relay_worker(reader, writer):
+    # Register the worker
+    BUS_WORKERS.add(writer)
+    try:
+        while True:
+            # Read a whole bus message from the worker
+            header = await reader.readexactly(BUS_HEADER.size)
+            _, target_size, msg_size = BUS_HEADER.unpack(header)
+            body = await reader.readexactly(target_size + msg_size)
+            
+            # Forward it to every other worker
+            others = [other for other in BUS_WORKERS if other is not writer]
+            for other in others:
+                other.writelines((header, body))
+                
+            # Slow down this worker if another one is not keeping up
+            for other in others:
+                await other.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except asyncio.CancelledError:
+        # The bus is shutting down, end quietly
+        pass
+    finally:
+        BUS_WORKERS.discard(writer)
+        writer.close()
+        
+#%%
+# =============================================================================
+# Resumable sessions
+
+# When a user leaves without QUIT, its name, room and the sequence number of the last
+# message of the room are kept under its token for RESUME_TTL seconds. A client reconnecting
+# with the token goes back to its room and gets the messages it missed, as far as the room
+# history goes, instead of the usual replay. With --wal-dir the sessions are saved when the
+# server shuts down, so they survive a restart or a hand-off along with the history.
+
+# With several workers a client may reconnect to another worker, so every session kept or
+# taken is also published on the message bus and every worker holds all the sessions. Each
+# worker saves its own file and every file is read on start.
+# =============================================================================
+
+def keep_session(user, room):
+    # Remember where the user was, and tell the other workers
+    session = (user.name, room, last_seq(room), time.time() + RESUME_TTL)
+    store_session(user.token, session)
+    if BUS_WRITER is not None:
+        publish_message(json.dumps(session).encode(), user.token, BUS_SESSION)
+        
+def store_session(token, session):
+    # Add a session, forgetting the oldest sessions above the limit
+    SESSIONS[token] = session
+    SESSIONS.move_to_end(token)
+    while len(SESSIONS) > RESUME_SESSIONS:
+        SESSIONS.popitem(last=False)
+        
+def take_session(token):
+    # Return the (name, room, last_seq, expires) session of a token, None if it has expired.
+    # The other workers forget it too, a token is only used once.
+    session = SESSIONS.pop(token, None)
+    if BUS_WRITER is not None and session is not None:
+        publish_message(b'', token, BUS_SESSION_TAKEN)
+    if session is None or session[3] < time.time():
+        return None
+    return session
+
+def sessions_path(wal_dir):
+    # File of the sessions of this process, each worker has its own
+    name = 'sessions.json' if WORKER_ID is None else f'sessions-{WORKER_ID}.json'
+    return os.path.join(wal_dir, name)
+
+def save_sessions(wal_dir):
+    # Write the sessions, including the users still connected, for the next process
+    for user in ALL_USERS.values():
+        keep_session(user, user.room)
+    path = sessions_path(wal_dir)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(list(SESSIONS.items()), file)
+    os.replace(path + '.tmp', path)
+    
+def load_sessions(wal_dir):
+    # Read the sessions saved by the previous process or workers, return the number still
+    # valid
+    for name in sorted(os.listdir(wal_dir)):
+        if not (name.startswith('sessions') and name.endswith('.json')):
+            continue
+        with open(os.path.join(wal_dir, name)) as file:
+            for token, session in json.load(file):
+                if session[3] > time.time():
+                    SESSIONS[token] = tuple(session)
+    return len(SESSIONS)
+
 #%%
 # =============================================================================
 # Connect a new client
 
-# Send a welcome message to a new user and ask for their name
+# Send a welcome message to a new user and ask for their name.
+# Before its name the client may ask for the framed protocol, the name then comes in a frame.
+# A client asking for compressed frames gets plain frames when compression is disabled.
 # =============================================================================
 
+async def read_name(reader, frame_reader):
+    # Read the next line, or the next frame of a framed client, b'' at the end of the stream
+    if frame_reader is None:
+        return await reader.readline()
+    frame = await frame_reader.read_frame()
+    return frame[1] if frame is not None else b''
+
 async def connect_user(reader, writer):
     # Get name message
     writer.write('Asyncio Chat Server\n'.encode())
     writer.write('Enter your name:\n'.encode())
-    await writer.drain()
     
-    # Ask the user for their name
-    name_bytes = await reader.readline()
+    # Close the connection if the name does not come
+    pending = PendingConnection(writer)
+    if WHEEL is not None:
+        WHEEL.schedule(pending, time.monotonic() + IDLE_TIMEOUT)
+        
+    # Ask the user for their name, the client may leave before answering
+    frame_reader = None
+    compress = False
+    session = None
+    try:
+        await writer.drain()
+        name_bytes = await reader.readline()
+        
+        # Switch to the framed protocol if asked, compressed if both sides agree
+        proto = name_bytes.decode().strip()
+        if proto in (PROTO_FRAMED, PROTO_DEFLATE):
+            compress = COMPRESSION and proto == PROTO_DEFLATE
+            writer.write(f"{DEFLATE_OK if compress else FRAMED_OK}\n".encode())
+            frame_reader = FrameReader(reader)
+            name_bytes = await read_name(reader, frame_reader)
+        codec = LINE if frame_reader is None else DEFLATE if compress else FRAMED
+        
+        # Convert name to string, a reconnecting client sends its token and its name
+        name = name_bytes.decode().strip()
+        if name.startswith(RESUME + ' '):
+            _, token, name = (name.split(' ', 2) + [''])[:3]
+            session = take_session(token)
+            if session is not None:
+                name = session[0]
+                
+        # Ask for another name while the name is taken, a resuming user keeps its session
+        for _ in range(NAME_ATTEMPTS - 1):
+            if not name or name_key(name) not in NAMES:
+                break
+            writer.write(encode_message(f"{NAME_TAKEN} {name}".encode(), codec))
+            writer.write(encode_message(b"Enter another name:", codec))
+            await writer.drain()
+            name = (await read_name(reader, frame_reader)).decode().strip()
+    except (ConnectionError, FrameError):
+        return None
+    finally:
+        if WHEEL is not None:
+            WHEEL.cancel(pending)
+    if not name or "\n" in name or name_key(name) in NAMES:
+        return None
+    
+    # Store the user details and put them in the default room, or back in their room
+    user = ChatUser(name, reader, writer, frame_reader, compress)
+    register_user(user)
+    if session is not None:
+        user.token = token
+    add_to_room(user, DEFAULT_ROOM if session is None else session[1])
     
-    # Convert name to string
-    name = name_bytes.decode().strip()
+    # Watch the connection for silence
+    if WHEEL is not None:
+        WHEEL.schedule(user, user.last_seen + PING_INTERVAL)
     
-    # Store the user details
-    global ALL_USERS
-    ALL_USERS[name] = (reader, writer)
+    # Catch up on the history of the room, or on what was missed since the last connection
+    replay_history(user, None if session is None else session[2])
     
-    # Announce the user
-    await broadcast_message(f"{name} has connected!\n")
+    # Announce the user with the other arrivals
+    announce_presence(name, user.room, "connected!" if session is None else "reconnected!")
     
-    # Give the welcome message
-    welcome = f"Welcome {name}. Send QUIT to disconnect.\n"
-    writer.write(welcome.encode())
-    await writer.drain()
+    # Give the resume token and the welcome message
+    user.send_text(f"{TOKEN} {user.token}")
+    user.send_text(f"Welcome {'' if session is None else 'back '}{name}. "
+                   f"You are in #{user.room}. Send JOIN <room> to change room, "
+                   f"LEAVE to return to #{DEFAULT_ROOM}, WHO and LIST to see the users and "
+                   f"the rooms, MSG <name> <text> to write to one user and QUIT to "
+                   f"disconnect.")
     
-    return name
+    return user
 
 #%%
 # =============================================================================
@@ -95,17 +1308,38 @@ async def connect_user(reader, writer):
 # Disconnect a client when requested
 # =============================================================================
 
-async def disconnect_user(name, writer):
-    # Close the user's connection
-    writer.close()
-    await writer.wait_closed()
+async def disconnect_user(user):
+    # Remove from the dict of all users and from the room
+    room = user.room
+    unregister_user(user)
+    remove_from_room(user)
+    if WHEEL is not None:
+        WHEEL.cancel(user)
+    
+    # Let the client resume unless the user quit
+    if not user.quit:
+        keep_session(user, room)
+        
+    # Keep the totals of the user in the metrics
+    LEFT_TOTALS['bytes_received'] += user.bytes_received
+    LEFT_TOTALS['bytes_sent'] += user.bytes_sent
+    LEFT_TOTALS['dropped'] += user.dropped
     
-    # Remove from the dict of all users
-    global ALL_USERS
-    del ALL_USERS[name]
+    # Stop the writer task if the user was behind
+    if user.task is not None:
+        user.task.cancel()
     
-    # Broadcast the user has left
-    await broadcast_message(f"{name} has left the room\n")
+    # Close the user's connection
+    user.writer.close()
+    try:
+        await user.writer.wait_closed()
+    except ConnectionError:
+        # The connection was dropped by the client or by the slow client policy
+        pass
+    
+    # Announce the user has left, unless everyone is leaving
+    if not DRAINING:
+        announce_presence(user.name, room, "left the room")
     
 #%%
 # =============================================================================
@@ -115,29 +1349,283 @@ async def disconnect_user(name, writer):
 # =============================================================================
 
 async def handle_chat_client(reader, writer):
-    print("Client connecting...")
+    LOG.info("Client connecting...")
     
     # Connect the user
-    name = await connect_user(reader, writer)
+    user = await connect_user(reader, writer)
+    if user is None:
+        writer.close()
+        return
+    
     try:
         # Read messages from the user
-        while True:
-            # Read a line of data
-            line_bytes = await reader.readline()
-            
-            # Convert to string
-            line = line_bytes.decode().strip()
-            
+        await read_messages(user)
+    finally:
+        # Disconnect the user
+        await disconnect_user(user)
+        
+async def read_messages(user):
+    global THROTTLED
+    while True:
+        # Read the next messages, a framed user may have sent several at once
+        try:
+            lines = await user.read_lines()
+        except (ConnectionError, FrameError):
+            return
+        
+        # Check for the end of the stream, the client is gone
+        if lines is None:
+            return
+        
+        for line in lines:
             # Check for exit
             if line == "QUIT":
-                break
+                user.quit = True
+                return
+            
+            # The answer to a PING has already been counted as activity
+            if line == PONG:
+                continue
+            MESSAGES_RECEIVED.inc()
             
-            # Broadcast a message
-            await broadcast_message(f"{name}: {line}\n")
+            recipients = handle_line(user, line)
+            
+            # Stop reading from a user over its limits, TCP pushes back meanwhile. The pause
+            # ends when the server closes the connection, a shutdown does not wait for it.
+            delay = throttle(user, recipients)
+            if delay:
+                THROTTLED += 1
+                await asyncio.wait([user.closed], timeout=delay)
+                if user.closed.done():
+                    return
+                
+            # Stop reading while the message bus is behind
+            if BUS_TASK is not None:
+                await asyncio.wait([BUS_TASK])
+            
+def prefix_lines(prefix, text):
+    # Put the prefix in front of every line of a message. A frame can hold several lines and
+    # a line client would read the lines after the first as lines sent by the server.
+    return "\n".join(prefix + line.rstrip() for line in text.split("\n"))
+
+def handle_line(user, line):
+    # Return the number of users written to, for the fan-out budget.
+    # Ignore the messages sent while the server shuts down.
+    if DRAINING:
+        return 0
     
-    finally:
-        # Disconnect the user
-        await disconnect_user(name, writer)
+    # Check for a change of room, a room name is a single line
+    command, _, argument = line.partition(' ')
+    if command == "JOIN" and argument.strip() and "\n" not in argument:
+        change_room(user, argument.strip())
+        return 1
+    if command == "LEAVE" and not argument:
+        change_room(user, DEFAULT_ROOM)
+        return 1
+    
+    # List the users of the room or the rooms
+    if line == "WHO":
+        send_snapshot(user, user.room)
+        return 1
+    if line == "LIST":
+        send_snapshot(user, None)
+        return 1
+    
+    # Send a direct message to one user
+    if command in ("MSG", "/msg"):
+        name, text = (argument.split(None, 1) + ['', ''])[:2]
+        if name and text.strip():
+            return send_direct(user, name, text.strip())
+        
+        # Never broadcast a mistyped direct message
+        user.send_text("Send MSG <name> <text> to write to one user.")
+        return 1
+        
+    # Broadcast a message to the room of the user and keep it in the history
+    broadcast_message(prefix_lines(f"{user.name}: ", line), user.room, record=True)
+    return len(ROOMS[user.room])
+    
+#%%
+# =============================================================================
+# Metrics
+
+# The hot path only adds to numbers: each user counts its own bytes and the broadcast time
+# goes into a histogram. Everything that can be read from the state of the server, like the
+# users, the queues or the socket buffers, is computed when the metrics are scraped.
+# With --admin-port the metrics are served in the Prometheus text format, for example
+# curl http://127.0.0.1:9100/metrics
+
+# The broadcast log goes through a queue to a thread that writes it, so a slow terminal
+# never blocks the event loop, and --log-sample N only logs one broadcast in N.
+# =============================================================================
+
+METRICS = Registry()
+
+# Totals of the users that have left, the connected users are added when scraped
+LEFT_TOTALS = {'bytes_received': 0, 'bytes_sent': 0, 'dropped': 0}
+
+# Numbers the broadcasts to sample the log
+LOG_COUNTER = itertools.count()
+
+def users_total(attribute):
+    # Total of a user counter over the users that have left and the connected ones
+    return LEFT_TOTALS[attribute] + sum(getattr(user, attribute) for user in ALL_USERS.values())
+
+METRICS.add(Gauge('chat_connected_users', "Users connected to this process",
+                  lambda: len(ALL_USERS)))
+METRICS.add(Gauge('chat_rooms', "Rooms with at least one user", lambda: len(ROOMS)))
+METRICS.add(Gauge('chat_users_behind', "Users with messages queued behind a full socket buffer",
+                  lambda: sum(user.task is not None for user in ALL_USERS.values())))
+METRICS.add(Gauge('chat_queued_messages', "Messages queued for the users that are behind",
+                  lambda: sum(user.queue.qsize() for user in ALL_USERS.values())))
+METRICS.add(Counter('chat_bytes_received_total', "Bytes read from the users",
+                    collect=lambda: users_total('bytes_received')))
+METRICS.add(Counter('chat_bytes_sent_total', "Bytes given to the user connections",
+                    collect=lambda: users_total('bytes_sent')))
+METRICS.add(Counter('chat_messages_dropped_total', "Messages dropped by the slow client policy",
+                    collect=lambda: users_total('dropped')))
+METRICS.add(Counter('chat_bus_messages_dropped_total',
+                    "Bus messages dropped because the bus queue was full",
+                    collect=lambda: BUS_DROPPED))
+METRICS.add(Counter('chat_reads_throttled_total', "Reads paused by the rate limits",
+                    collect=lambda: THROTTLED))
+MESSAGES_RECEIVED = METRICS.add(Counter('chat_messages_received_total',
+                                        "Lines received from the users"))
+BROADCAST_SECONDS = METRICS.add(Histogram('chat_broadcast_seconds',
+                                          "Time to hand a message to every user of a room",
+                                          exponential_buckets(1e-6, 4, 10)))
+METRICS.add(Histogram('chat_write_buffer_bytes', "Bytes in the socket buffer of each user",
+                      [0] + exponential_buckets(1024, 4, 8),
+                      collect=lambda: [user.transport.get_write_buffer_size()
+                                       for user in ALL_USERS.values()]))
+LOOP_LAG_SECONDS = METRICS.add(Histogram('chat_loop_lag_seconds',
+                                         "Lateness of a 100 ms sleep on the event loop",
+                                         exponential_buckets(1e-4, 4, 8)))
+
+def start_logging():
+    # Hand the log records to a thread that writes them to stdout
+    log_queue = queue.SimpleQueue()
+    LOG.addHandler(logging.handlers.QueueHandler(log_queue))
+    LOG.setLevel(logging.INFO)
+    LOG.propagate = False
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    listener.start()
+    return listener
+
+#%%
+# =============================================================================
+# Status report
+
+# Coroutine that reports the state of the server now and then
+# =============================================================================
+
+async def report_status(label):
+    while True:
+        await asyncio.sleep(REPORT_INTERVAL)
+        
+        # Report the users, the rooms and the memory held by the histories
+        messages, size = history_memory()
+        print(f"{label} status: {len(ALL_USERS)} users, {len(ROOMS)} rooms, "
+              f"history of {len(HISTORIES)} rooms holds {messages} messages in {size} bytes, "
+              f"{THROTTLED} reads throttled")
+        
+#%%
+# =============================================================================
+# Graceful shutdown
+
+# SIGTERM stops the server without losing what is in flight: it stops accepting connections,
+# ignores new messages, commits the log, tells every user and closes the connections once
+# their queued messages are written. The users are closed in batches over DRAIN_SPREAD
+# seconds so they do not all reconnect at once, and after DRAIN_TIMEOUT seconds the
+# connections still writing are dropped.
+
+# SIGHUP hands over to a new process first. The same command is started again and inherits
+# the listening sockets, so the port never stops accepting: new connections queue in the
+# kernel and the new process accepts them while this one drains its users.
+# =============================================================================
+
+def request_stop(stop, handoff):
+    # Signal handler, the first signal decides how the server stops
+    if not stop.done():
+        stop.set_result(handoff)
+        
+def start_successor(servers):
+    # Start this command again, passing the listening sockets instead of the options
+    # telling a previous successor about its inherited sockets
+    argv = []
+    skip = False
+    for arg in sys.argv:
+        if skip or arg in ('--inherit-fd', '--inherit-unix-fd'):
+            skip = not skip
+            continue
+        argv.append(arg)
+        
+    # Every listening socket of every server, TCP or Unix
+    fds = []
+    for server in servers:
+        for sock in server.sockets:
+            fds.append(sock.fileno())
+            option = '--inherit-unix-fd' if sock.family == socket.AF_UNIX else '--inherit-fd'
+            argv += [option, str(fds[-1])]
+    return subprocess.Popen([sys.executable, *argv], pass_fds=fds)
+
+async def close_user(user):
+    # Write the coalesced messages, they are older than the queued ones
+    user.flush()
+    
+    # Wait for the writer task to empty the queue of the user, the connection closes once
+    # its buffer is written
+    if user.task is not None:
+        await asyncio.wait([user.task])
+    user.writer.close()
+    user.closed.set_result(None)
+    try:
+        await user.writer.wait_closed()
+    except ConnectionError:
+        pass
+    
+async def drain_server(servers, handoff):
+    global DRAINING, HANDED_OFF
+    DRAINING = True
+    
+    # Commit the log and save the sessions, a new process restores them. Each worker saves
+    # the sessions it holds, with those of its own users.
+    if WAL is not None:
+        await WAL.commit()
+    if WAL_DIR is not None:
+        save_sessions(WAL_DIR)
+        
+    # Give the listening sockets to a new process, then stop accepting here
+    if handoff:
+        process = start_successor(servers)
+        HANDED_OFF = True
+        print(f"Handed the listening sockets over to process {process.pid}")
+    for server in servers:
+        server.close()
+        
+    # Tell every user, then close the users in batches over the spread
+    users = list(ALL_USERS.values())
+    print(f"Draining {len(users)} users...")
+    notice = "Server restarting, please reconnect." if handoff else "Server shutting down."
+    for user in users:
+        user.send_text(notice)
+        
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    steps = max(1, int(DRAIN_SPREAD / 0.1))
+    batch_size = math.ceil(len(users) / steps) or 1
+    closing = []
+    for start in range(0, len(users), batch_size):
+        closing += [asyncio.create_task(close_user(user))
+                    for user in users[start:start + batch_size]]
+        await asyncio.sleep(DRAIN_SPREAD / steps)
+        
+    # Drop the connections still writing at the deadline
+    if closing:
+        _, pending = await asyncio.wait(closing, timeout=max(0, deadline - time.monotonic()))
+        for user, task in zip(users, closing):
+            if task in pending:
+                user.transport.abort()
+        print(f"Drained, {len(pending)} users dropped at the deadline")
         
 #%%
 # =============================================================================
@@ -146,30 +1634,294 @@ async def handle_chat_client(reader, writer):
 # Coroutine for creating the main server
 # =============================================================================
 
-async def main():
-     # Define the local host
-     host_address, host_port = '127.0.0.1', 8887
+async def main(reuse_port=False, label="Chat Server", log_writer=True, admin_offset=0):
+     # Write the log from a thread
+     listener = start_logging()
      
-     # Create the asyncio server
-     server = await asyncio.start_server(handle_chat_client,
-                                         host_address,
-                                         host_port)
+     # Rebuild the room histories from the log and keep logging the messages
+     global WAL
+     if WAL_DIR is not None:
+         os.makedirs(WAL_DIR, exist_ok=True)
+         print(f"{label} restored {load_history(WAL_DIR)} messages and "
+               f"{load_sessions(WAL_DIR)} sessions from {WAL_DIR}")
+         if log_writer:
+             WAL = WriteAheadLog(WAL_DIR, WAL_INTERVAL, WAL_SEGMENT_BYTES, WAL_SEGMENTS)
+             WAL.start()
+             
+     # Create the asyncio server, with reuse_port several processes can share the port.
+     # After a hand-off the listening sockets come from the previous process.
+     if INHERITED_SOCKETS is not None:
+         servers = [await asyncio.start_server(handle_chat_client, sock=sock, ssl=SSL_CONTEXT)
+                    for sock in INHERITED_SOCKETS]
+         server = servers[0]
+     else:
+         server = await asyncio.start_server(handle_chat_client,
+                                             HOST,
+                                             PORT,
+                                             reuse_port=reuse_port,
+                                             ssl=SSL_CONTEXT)
+         servers = [server]
      
+     # Serve the clients on the same host through the Unix socket, with the same handler
+     if UNIX_SOCKET is not None:
+         unix_server = await asyncio.start_unix_server(handle_chat_client, sock=UNIX_SOCKET)
+         servers.append(unix_server)
+         print(f"{label} Running on {UNIX_SOCKET.getsockname()}")
+         
+     # Drain on SIGTERM, hand over to a new process on SIGHUP. The workers share their port
+     # with SO_REUSEPORT and have no single socket to hand over.
+     loop = asyncio.get_running_loop()
+     stop = loop.create_future()
+     loop.add_signal_handler(signal.SIGTERM, request_stop, stop, False)
+     if not reuse_port:
+         loop.add_signal_handler(signal.SIGHUP, request_stop, stop, True)
+         
      # Run the server
      async with server:
          # Report a message
-         print("Chat Server Running\nWaiting for chat clients...")
+         print(f"{label} Running on {HOST}:{PORT}\nWaiting for chat clients...")
+         
+         # Report the state of the server in the background
+         status_task = asyncio.create_task(report_status(label))
          
-         # Accept connections
-         await server.serve_forever()
+         # Watch the idle connections
+         if WHEEL is not None:
+             wheel_task = asyncio.create_task(WHEEL.run())
+             
+         # Serve the metrics on the admin port and measure the event loop lag
+         if ADMIN_PORT is not None:
+             admin = await serve_metrics(METRICS, ADMIN_HOST, ADMIN_PORT + admin_offset)
+             lag_task = asyncio.create_task(monitor_loop_lag(LOOP_LAG_SECONDS))
+             print(f"{label} metrics on http://{ADMIN_HOST}:{ADMIN_PORT + admin_offset}/metrics")
          
+         # Accept connections until a signal stops the server
+         try:
+             handoff = await stop
+             await drain_server(servers, handoff)
+         finally:
+             # Commit the last messages to the log
+             if WAL is not None:
+                 await WAL.close()
+             listener.stop()
+                 
 #%%
 # =============================================================================
-# Start the event loop
+# Drive several worker processes
+
+# The parent process creates the bus socket, forks the workers and then relays the bus
+# messages until it is stopped. Each worker runs its own event loop.
 # =============================================================================
 
-# Define the dictionary for all the users
-ALL_USERS = {}
+async def worker_main(worker_id, bus_path):
+    # Connect to the message bus of the parent process
+    global BUS_WRITER, WORKER_ID
+    WORKER_ID = worker_id
+    bus_reader, BUS_WRITER = await asyncio.open_unix_connection(bus_path)
+    
+    # Deliver the messages of the other workers in the background
+    bus_task = asyncio.create_task(read_bus(bus_reader))
+    
+    # Serve the chat clients on the shared port, every worker sees every message so only the
+    # first one writes the log
+    await main(reuse_port=True, label=f"Worker {worker_id}", log_writer=worker_id == 0,
+               admin_offset=worker_id)
+    
+def run_worker(worker_id, bus_path, bus_socket):
+    # The listening bus socket belongs to the parent
+    bus_socket.close()
+    
+    try:
+        asyncio.run(worker_main(worker_id, bus_path))
+    except KeyboardInterrupt:
+        pass
+    
+async def run_bus(bus_socket):
+    # Relay the bus messages between the workers
+    bus = await asyncio.start_unix_server(relay_worker, sock=bus_socket)
+    
+    # Stop relaying on SIGTERM so the workers are stopped too
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, bus.close)
+    
+    async with bus:
+        try:
+            await bus.serve_forever()
+        except asyncio.CancelledError:
+            print("Stopping the workers...")
+        
+def listen_unix(path):
+    # Create a listening Unix socket, replacing the file left by a previous run
+    if os.path.exists(path):
+        os.unlink(path)
+    unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    unix_socket.bind(path)
+    unix_socket.listen(socket.SOMAXCONN)
+    return unix_socket
 
+def run_workers(n_workers, bus_path):
+    # Create the bus socket before forking so the workers can connect right away
+    bus_socket = listen_unix(bus_path)
+    
+    # Fork the workers, they inherit the server settings of this process
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=run_worker, args=(i, bus_path, bus_socket), daemon=True)
+               for i in range(n_workers)]
+    for worker in workers:
+        worker.start()
+        
+    # The workers share the chat Unix socket, the parent does not accept on it
+    if UNIX_SOCKET is not None:
+        UNIX_SOCKET.close()
+        
+    try:
+        asyncio.run(run_bus(bus_socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Stop the workers and remove the bus socket
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        os.unlink(bus_path)
+        
+#%%
+# =============================================================================
+# Command line options
+# =============================================================================
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Asyncio group chat server")
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                        help="messages buffered per user before the slow client policy applies")
+    parser.add_argument('--slow-policy', choices=SLOW_CLIENT_POLICIES, default=SLOW_CLIENT_POLICY,
+                        help="what to do with a user whose queue is full")
+    parser.add_argument('--host', default=HOST, help="address to listen on")
+    parser.add_argument('--port', type=int, default=PORT, help="port to listen on")
+    parser.add_argument('--unix', default=None,
+                        help="path of a Unix socket to also listen on, for clients on this host")
+    parser.add_argument('--drain-spread', type=float, default=DRAIN_SPREAD,
+                        help="seconds over which the users are disconnected on shutdown")
+    parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT,
+                        help="seconds to write the last messages on shutdown")
+    parser.add_argument('--inherit-fd', type=int, action='append', help=argparse.SUPPRESS)
+    parser.add_argument('--inherit-unix-fd', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--no-compression', action='store_true',
+                        help="refuse compressed frames, clients asking for them get plain frames")
+    parser.add_argument('--certfile', default=None,
+                        help="certificate of the server, the clients then connect with TLS")
+    parser.add_argument('--keyfile', default=None,
+                        help="private key of the server if it is not in the certificate file")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes sharing the port with SO_REUSEPORT")
+    parser.add_argument('--bus-path', default=None,
+                        help="Unix socket used to relay messages between the workers")
+    parser.add_argument('--coalesce-messages', type=int, default=0,
+                        help="join up to this many messages per user into one write, 0 to disable")
+    parser.add_argument('--coalesce-delay', type=float, default=1000.0,
+                        help="longest coalescing window in microseconds under load")
+    parser.add_argument('--history-size', type=int, default=HISTORY_SIZE,
+                        help="chat messages kept per room")
+    parser.add_argument('--history-bytes', type=int, default=HISTORY_BYTES,
+                        help="payload bytes kept per room")
+    parser.add_argument('--history-rooms', type=int, default=HISTORY_ROOMS,
+                        help="rooms with a history, the least recently active is dropped first")
+    parser.add_argument('--history-replay', type=int, default=HISTORY_REPLAY,
+                        help="messages replayed to a user entering a room")
+    parser.add_argument('--presence-delay', type=float, default=PRESENCE_DELAY * 1000,
+                        help="milliseconds during which joins and departures are collected "
+                             "into one announcement")
+    parser.add_argument('--report-interval', type=float, default=REPORT_INTERVAL,
+                        help="seconds between two status reports")
+    parser.add_argument('--wal-dir', default=None,
+                        help="directory of the write-ahead log of the chat messages")
+    parser.add_argument('--wal-interval', type=float, default=WAL_INTERVAL * 1000,
+                        help="milliseconds between two group commits of the log")
+    parser.add_argument('--wal-segment-bytes', type=int, default=WAL_SEGMENT_BYTES,
+                        help="size of a log segment")
+    parser.add_argument('--wal-segments', type=int, default=WAL_SEGMENTS,
+                        help="log segments kept on disk")
+    parser.add_argument('--resume-ttl', type=float, default=RESUME_TTL,
+                        help="seconds a user that left can resume its session")
+    parser.add_argument('--ping-interval', type=float, default=PING_INTERVAL,
+                        help="seconds of silence before a user is sent a PING")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help="seconds of silence before a connection is closed, 0 to disable")
+    parser.add_argument('--rate-limit', type=float, default=RATE_LIMIT,
+                        help="messages per second a user may send, 0 to disable")
+    parser.add_argument('--rate-burst', type=float, default=RATE_BURST,
+                        help="messages a user may send at once before the rate limit applies")
+    parser.add_argument('--admin-port', type=int, default=None,
+                        help="local port serving the metrics, worker N uses the port + N")
+    parser.add_argument('--log-sample', type=int, default=LOG_SAMPLE,
+                        help="log one broadcast in this many, 0 to log none")
+    parser.add_argument('--fanout-budget', type=float, default=0,
+                        help="messages written to recipients per second by the whole server, "
+                             "0 to disable")
+    args = parser.parse_args()
+    
+    # The timing wheel ticks a fraction of the ping interval
+    if args.idle_timeout > 0 and args.ping_interval <= 0:
+        parser.error("--ping-interval must be greater than 0 unless --idle-timeout is 0")
+    if args.wal_segments < 1:
+        parser.error("--wal-segments must be at least 1")
+    return args
+
+#%%
+# =============================================================================
 # Start the event loop
-asyncio.run(main())
\ No newline at end of file
+# =============================================================================
+
+# Protect the entry point
+if __name__ == '__main__':
+    # Apply the command line settings
+    args = parse_args()
+    QUEUE_SIZE = args.queue_size
+    SLOW_CLIENT_POLICY = args.slow_policy
+    HOST, PORT = args.host, args.port
+    COMPRESSION = not args.no_compression
+    if args.certfile is not None:
+        # Made before forking so the workers share the session ticket keys
+        SSL_CONTEXT = server_tls_context(args.certfile, args.keyfile)
+    HISTORY_SIZE, HISTORY_BYTES = args.history_size, args.history_bytes
+    HISTORY_ROOMS, HISTORY_REPLAY = args.history_rooms, args.history_replay
+    REPORT_INTERVAL = args.report_interval
+    PRESENCE_DELAY = args.presence_delay / 1000
+    WAL_DIR, WAL_INTERVAL = args.wal_dir, args.wal_interval / 1000
+    WAL_SEGMENT_BYTES, WAL_SEGMENTS = args.wal_segment_bytes, args.wal_segments
+    PING_INTERVAL, IDLE_TIMEOUT = args.ping_interval, args.idle_timeout
+    RESUME_TTL = args.resume_ttl
+    RATE_LIMIT, RATE_BURST = args.rate_limit, args.rate_burst
+    ADMIN_PORT, LOG_SAMPLE = args.admin_port, args.log_sample
+    if args.fanout_budget > 0:
+        # Allow a second worth of the budget at once
+        FANOUT_BUDGET = TokenBucket(args.fanout_budget, args.fanout_budget)
+    if IDLE_TIMEOUT > 0:
+        # Tick often enough for short timeouts, but no more than once a second
+        tick = min(1.0, PING_INTERVAL / 4, IDLE_TIMEOUT / 4)
+        WHEEL = TimingWheel(tick, max(PING_INTERVAL, IDLE_TIMEOUT))
+    if args.coalesce_messages > 1:
+        COALESCER = WriteCoalescer(args.coalesce_messages, args.coalesce_delay / 1e6)
+    
+    DRAIN_SPREAD, DRAIN_TIMEOUT = args.drain_spread, args.drain_timeout
+    
+    # Take over the listening sockets of the previous process, or listen on the Unix socket
+    # before forking so every worker accepts on it
+    if args.inherit_fd:
+        INHERITED_SOCKETS = [socket.socket(fileno=fd) for fd in args.inherit_fd]
+    if args.inherit_unix_fd is not None:
+        UNIX_SOCKET = socket.socket(fileno=args.inherit_unix_fd)
+    elif args.unix is not None:
+        UNIX_SOCKET = listen_unix(args.unix)
+    
+    try:
+        if args.workers > 1:
+            # Run the workers and relay messages between them
+            bus_path = args.bus_path or os.path.join(tempfile.gettempdir(),
+                                                     f"chat-bus-{PORT}.sock")
+            run_workers(args.workers, bus_path)
+        else:
+            # Start the event loop
+            asyncio.run(main())
+    finally:
+        # The Unix socket file now belongs to the new process after a hand-off
+        if args.unix is not None and not HANDED_OFF and os.path.exists(args.unix):
+            os.unlink(args.unix)
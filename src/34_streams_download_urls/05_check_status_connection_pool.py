@@ -0,0 +1,246 @@
+# SuperFastPython.com
+# check the status of many webpages reusing keep-alive connections
+import asyncio
+from collections import defaultdict
+from urllib.parse import urlsplit
+from time import perf_counter
+
+# bytes read at a time when skipping a response body
+READ_SIZE = 64 * 1024
+
+# pool of open connections for each host
+class ConnectionPool:
+    # create an empty pool that opens at most max_per_host connections to a host
+    def __init__(self, max_per_host=10):
+        self.max_per_host = max_per_host
+        # idle connections for each (scheme, host, port)
+        self.idle = defaultdict(list)
+        # limit on the connections in use for each (scheme, host, port)
+        self.limits = defaultdict(lambda: asyncio.Semaphore(self.max_per_host))
+        # number of connections opened
+        self.opened = 0
+
+    # borrow a connection to a host, reusing an idle one when possible
+    async def acquire(self, key):
+        # wait for the host to be below its limit
+        await self.limits[key].acquire()
+        # take the most recently used idle connection still open
+        idle = self.idle[key]
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        # open a new connection, giving back the slot if it fails
+        scheme, host, port = key
+        try:
+            reader, writer = await asyncio.open_connection(
+                host, port, ssl=True if scheme == 'https' else None)
+        except BaseException:
+            self.limits[key].release()
+            raise
+        self.opened += 1
+        return reader, writer, False
+
+    # give a connection back, keeping it open if it can be reused
+    def release(self, key, reader, writer, reuse):
+        if reuse:
+            self.idle[key].append((reader, writer))
+        else:
+            writer.close()
+        self.limits[key].release()
+
+    # close all the idle connections
+    async def close(self):
+        writers = [writer for idle in self.idle.values() for _, writer in idle]
+        self.idle.clear()
+        for writer in writers:
+            writer.close()
+        # wait for the connections to close, ignoring servers that already left
+        await asyncio.gather(*[writer.wait_closed() for writer in writers],
+            return_exceptions=True)
+
+# skip a number of bytes of the body
+async def skip_bytes(reader, size):
+    while size > 0:
+        data = await reader.read(min(size, READ_SIZE))
+        if not data:
+            raise asyncio.IncompleteReadError(b'', size)
+        size -= len(data)
+
+# read a whole response, return the status line and if the connection can be reused
+async def read_response(reader):
+    # read the status line, the server may have closed an idle connection
+    status = (await reader.readline()).decode().strip()
+    if not status:
+        raise ConnectionResetError('connection closed by the server')
+    # read the headers up to the blank line
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+    # the connection is kept unless the server asks to close it
+    reuse = status.startswith('HTTP/1.1') and headers.get('connection') != 'close'
+    # read the body, so the next response starts at the right place
+    code = status.split()[1] if len(status.split()) > 1 else ''
+    if code.startswith('1') or code in ('204', '304'):
+        # no body
+        pass
+    elif 'chunked' in headers.get('transfer-encoding', ''):
+        # chunks of a hexadecimal size, ending with an empty chunk and the trailers
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            await skip_bytes(reader, size + 2)
+    elif 'content-length' in headers:
+        await skip_bytes(reader, int(headers['content-length']))
+    else:
+        # the body ends when the server closes the connection
+        while await reader.read(READ_SIZE):
+            pass
+        reuse = False
+    return status, reuse
+
+# get the HTTP/S status of a webpage over a pooled connection
+async def get_status(url, pool):
+    # split the url into components
+    url_parsed = urlsplit(url)
+    port = url_parsed.port or (443 if url_parsed.scheme == 'https' else 80)
+    key = (url_parsed.scheme, url_parsed.hostname, port)
+    # build the GET request, keeping the connection open
+    path = url_parsed.path or '/'
+    if url_parsed.query:
+        path += '?' + url_parsed.query
+    query = f'GET {path} HTTP/1.1\r\n' + \
+        f'Host: {url_parsed.netloc}\r\n' + \
+        'Connection: keep-alive\r\n\r\n'
+    # try again on a new connection if an idle one was closed by the server
+    while True:
+        reader, writer, reused = await pool.acquire(key)
+        try:
+            # write query to socket
+            writer.write(query.encode())
+            # wait for the bytes to be written to the socket
+            await writer.drain()
+            # read the whole response
+            status, reuse = await read_response(reader)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pool.release(key, reader, writer, False)
+            if reused:
+                continue
+            raise
+        except BaseException:
+            pool.release(key, reader, writer, False)
+            raise
+        # give the connection back to the pool
+        pool.release(key, reader, writer, reuse)
+        return status
+
+# get the HTTP/S status of a webpage with a new connection, as the other examples do
+async def get_status_new_connection(url):
+    # split the url into components
+    url_parsed = urlsplit(url)
+    # open the connection
+    reader, writer = await asyncio.open_connection(
+        url_parsed.hostname, url_parsed.port)
+    # send GET request
+    query = f'GET {url_parsed.path} HTTP/1.1\r\n' + \
+        f'Host: {url_parsed.netloc}\r\n\r\n'
+    # write query to socket
+    writer.write(query.encode())
+    # wait for the bytes to be written to the socket
+    await writer.drain()
+    # read the single line response
+    response = await reader.readline()
+    # close the connection
+    writer.close()
+    await writer.wait_closed()
+    # decode and strip white space
+    return response.decode().strip()
+
+# handle the requests of one client of the local test server
+async def handle_client(reader, writer):
+    try:
+        while True:
+            # read the request line and the headers
+            request = await reader.readline()
+            if not request:
+                break
+            close = False
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                line = line.lower()
+                if line.startswith(b'connection:') and b'close' in line:
+                    close = True
+            # answer with a chunked body or a body of known length
+            path = request.split()[1]
+            body = b'<html>' + b'x' * 2000 + b'</html>'
+            if path.startswith(b'/chunked'):
+                writer.write(b'HTTP/1.1 200 OK\r\n' +
+                    b'Transfer-Encoding: chunked\r\n\r\n')
+                for start in range(0, len(body), 500):
+                    chunk = body[start:start + 500]
+                    writer.write(f'{len(chunk):x}\r\n'.encode() + chunk + b'\r\n')
+                writer.write(b'0\r\n\r\n')
+            else:
+                writer.write(b'HTTP/1.1 200 OK\r\n' +
+                    f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+            if close:
+                break
+    except ConnectionError:
+        pass
+    writer.close()
+
+# check all urls, at most limit at a time
+async def check_all(urls, check, limit):
+    semaphore = asyncio.Semaphore(limit)
+    # check one url once a slot is free
+    async def check_one(url):
+        async with semaphore:
+            return await check(url)
+    return await asyncio.gather(*[check_one(url) for url in urls])
+
+# main coroutine
+async def main():
+    # start local servers standing for different hosts, no network needed
+    servers = [await asyncio.start_server(handle_client, '127.0.0.1', 0)
+        for _ in range(4)]
+    ports = [server.sockets[0].getsockname()[1] for server in servers]
+    # many pages on few hosts, half of them with a chunked body
+    urls = [f'http://127.0.0.1:{ports[i % len(ports)]}/'
+        f'{"chunked" if i % 2 else "page"}/{i}' for i in range(5000)]
+    # check the pages with a new connection for each request
+    time_start = perf_counter()
+    results = await check_all(urls, get_status_new_connection, 100)
+    time_new = perf_counter() - time_start
+    print(f'new connections: {len(urls)} checks, {len(urls)} connections, '
+        f'{time_new:.3f} seconds, {len(urls) / time_new:.0f} checks/sec')
+    # check the pages again over pooled keep-alive connections
+    pool = ConnectionPool(max_per_host=25)
+    time_start = perf_counter()
+    results = await check_all(urls, lambda url: get_status(url, pool), 100)
+    time_pool = perf_counter() - time_start
+    print(f'pooled:          {len(urls)} checks, {pool.opened} connections, '
+        f'{time_pool:.3f} seconds, {len(urls) / time_pool:.0f} checks/sec')
+    # report the statuses seen
+    print(f'statuses: {sorted(set(results))}, speedup {time_new / time_pool:.1f}x')
+    # close the connections and the servers
+    await pool.close()
+    for server in servers:
+        server.close()
+        await server.wait_closed()
+
+# record start time
+time_start = perf_counter()
+# start the asyncio event loop
+asyncio.run(main())
+# calculate duration
+time_duration = perf_counter() - time_start
+# report duration
+print(f'Took {time_duration:.3f} seconds')
@@ -0,0 +1,402 @@
+# SuperFastPython.com
+# check the status of many webpages resolving each host name once
+import asyncio
+import json
+import os
+import socket
+import sys
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from time import perf_counter
+
+# bytes read at a time when skipping a response body
+READ_SIZE = 64 * 1024
+
+# most requests in flight at once
+MAX_IN_FLIGHT = 200
+
+# seconds allowed for one check
+TIMEOUT = 10
+
+# most idle connections kept open over all hosts
+MAX_IDLE = 100
+
+# resolver asking the system, getaddrinfo runs in the default thread pool
+class SystemResolver:
+    # return the addresses of a host name
+    async def resolve(self, host):
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        return [info[4][0] for info in infos]
+
+# resolver for tests, answering from a dictionary after a delay like a dns server
+class StubResolver:
+    # store the host names and their addresses
+    def __init__(self, addresses, delay=0.0):
+        self.addresses = addresses
+        self.delay = delay
+        # number of lookups answered
+        self.lookups = 0
+
+    # return the addresses of a host name, as getaddrinfo fails for unknown ones
+    async def resolve(self, host):
+        self.lookups += 1
+        await asyncio.sleep(self.delay)
+        if host not in self.addresses:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return self.addresses[host]
+
+# resolver remembering the answers of another resolver
+class CachingResolver:
+    # wrap a resolver, keeping addresses for ttl seconds and failures for negative_ttl,
+    # for at most max_entries host names
+    def __init__(self, resolver, ttl=300, negative_ttl=30, max_entries=10000):
+        self.resolver = resolver
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        # host -> (expiry time, addresses or error), least recently stored first
+        self.cache = OrderedDict()
+        # host -> task of the lookup in progress
+        self.in_flight = {}
+
+    # return the addresses of a host name
+    async def resolve(self, host):
+        loop = asyncio.get_running_loop()
+        # answer from the cache while the entry is fresh
+        entry = self.cache.get(host)
+        if entry is not None:
+            if entry[0] > loop.time():
+                if isinstance(entry[1], Exception):
+                    raise entry[1].with_traceback(None)
+                return entry[1]
+            # forget the expired entry
+            del self.cache[host]
+        # join the lookup of the host in progress, or start it
+        task = self.in_flight.get(host)
+        if task is None:
+            task = asyncio.create_task(self.lookup(host))
+            self.in_flight[host] = task
+            # the lookup goes on if its callers give up, read its error anyway
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        # a caller that is cancelled does not cancel the lookup of the others
+        return await asyncio.shield(task)
+
+    # ask the wrapped resolver and remember its answer
+    async def lookup(self, host):
+        loop = asyncio.get_running_loop()
+        try:
+            addresses = await self.resolver.resolve(host)
+        except socket.gaierror as e:
+            # remember that the name does not resolve, for a shorter time
+            self.store(host, (loop.time() + self.negative_ttl, e))
+            raise
+        finally:
+            del self.in_flight[host]
+        self.store(host, (loop.time() + self.ttl, addresses))
+        return addresses
+
+    # remember an answer, forgetting the oldest ones over the limit
+    def store(self, host, entry):
+        self.cache.pop(host, None)
+        self.cache[host] = entry
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+
+# pool of open connections for each host
+class ConnectionPool:
+    # create an empty pool that opens at most max_per_host connections to a host and
+    # keeps at most max_idle idle ones, finding the address of a host with the resolver
+    def __init__(self, resolver, max_per_host=10, max_idle=MAX_IDLE):
+        self.resolver = resolver
+        self.max_per_host = max_per_host
+        self.max_idle = max_idle
+        # idle connections for each (scheme, host, port), oldest first
+        self.idle = {}
+        # idle connections of all hosts, least recently used first: writer -> key
+        self.lru = OrderedDict()
+        # limit on the connections in use for each (scheme, host, port), and the number
+        # of checks holding or waiting for a connection to it
+        self.limits = {}
+        self.users = {}
+        # number of connections opened
+        self.opened = 0
+
+    # borrow a connection to a host, reusing an idle one when possible
+    async def acquire(self, key):
+        # wait for the host to be below its limit
+        if key not in self.limits:
+            self.limits[key] = asyncio.Semaphore(self.max_per_host)
+        self.users[key] = self.users.get(key, 0) + 1
+        try:
+            await self.limits[key].acquire()
+        except BaseException:
+            self.forget(key)
+            raise
+        # take the most recently used idle connection still open
+        while key in self.idle:
+            reader, writer = self.take_idle(key, -1)
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        # open a new connection, giving back the slot if it fails
+        try:
+            reader, writer = await self.connect(*key)
+        except BaseException:
+            self.limits[key].release()
+            self.forget(key)
+            raise
+        self.opened += 1
+        return reader, writer, False
+
+    # open a connection to the first address of the host that answers
+    async def connect(self, scheme, host, port):
+        addresses = await self.resolver.resolve(host)
+        error = OSError(f'no addresses for {host}')
+        for address in addresses:
+            try:
+                # tls checks the certificate against the host name, not the address
+                if scheme == 'https':
+                    return await asyncio.open_connection(
+                        address, port, ssl=True, server_hostname=host)
+                return await asyncio.open_connection(address, port)
+            except OSError as e:
+                error = e
+        raise error
+
+    # give a connection back, keeping it open if it can be reused
+    def release(self, key, reader, writer, reuse):
+        if reuse:
+            self.idle.setdefault(key, []).append((reader, writer))
+            self.lru[writer] = key
+            # close the least recently used idle connection over the limit
+            if len(self.lru) > self.max_idle:
+                _, oldest = self.take_idle(next(iter(self.lru.values())), 0)
+                oldest.close()
+        else:
+            writer.close()
+        self.limits[key].release()
+        self.forget(key)
+
+    # take an idle connection of a host out of the pool, oldest at 0, newest at -1
+    def take_idle(self, key, index):
+        idle = self.idle[key]
+        reader, writer = idle.pop(index)
+        del self.lru[writer]
+        if not idle:
+            del self.idle[key]
+        return reader, writer
+
+    # forget the limit of a host once no check holds or waits for one of its connections
+    def forget(self, key):
+        self.users[key] -= 1
+        if not self.users[key]:
+            del self.users[key]
+            del self.limits[key]
+
+    # close all the idle connections
+    async def close(self):
+        writers = list(self.lru)
+        self.idle.clear()
+        self.lru.clear()
+        for writer in writers:
+            writer.close()
+        # wait for the connections to close, ignoring servers that already left
+        await asyncio.gather(*[writer.wait_closed() for writer in writers],
+            return_exceptions=True)
+
+# skip a number of bytes of the body
+async def skip_bytes(reader, size):
+    while size > 0:
+        data = await reader.read(min(size, READ_SIZE))
+        if not data:
+            raise asyncio.IncompleteReadError(b'', size)
+        size -= len(data)
+
+# read a whole response, return the status line and if the connection can be reused
+async def read_response(reader):
+    # read the status line, the server may have closed an idle connection
+    status = (await reader.readline()).decode().strip()
+    if not status:
+        raise ConnectionResetError('connection closed by the server')
+    # read the headers up to the blank line
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+    # the connection is kept unless the server asks to close it
+    reuse = status.startswith('HTTP/1.1') and headers.get('connection') != 'close'
+    # read the body, so the next response starts at the right place
+    code = status.split()[1] if len(status.split()) > 1 else ''
+    if code.startswith('1') or code in ('204', '304'):
+        # no body
+        pass
+    elif 'chunked' in headers.get('transfer-encoding', ''):
+        # chunks of a hexadecimal size, ending with an empty chunk and the trailers
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            await skip_bytes(reader, size + 2)
+    elif 'content-length' in headers:
+        await skip_bytes(reader, int(headers['content-length']))
+    else:
+        # the body ends when the server closes the connection
+        while await reader.read(READ_SIZE):
+            pass
+        reuse = False
+    return status, reuse
+
+# get the HTTP/S status of a webpage over a pooled connection
+async def get_status(url, pool):
+    # split the url into components
+    url_parsed = urlsplit(url)
+    port = url_parsed.port or (443 if url_parsed.scheme == 'https' else 80)
+    key = (url_parsed.scheme, url_parsed.hostname, port)
+    # build the GET request, keeping the connection open
+    path = url_parsed.path or '/'
+    if url_parsed.query:
+        path += '?' + url_parsed.query
+    query = f'GET {path} HTTP/1.1\r\n' + \
+        f'Host: {url_parsed.netloc}\r\n' + \
+        'Connection: keep-alive\r\n\r\n'
+    # try again on a new connection if an idle one was closed by the server
+    while True:
+        reader, writer, reused = await pool.acquire(key)
+        try:
+            # write query to socket
+            writer.write(query.encode())
+            # wait for the bytes to be written to the socket
+            await writer.drain()
+            # read the whole response
+            status, reuse = await read_response(reader)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pool.release(key, reader, writer, False)
+            if reused:
+                continue
+            raise
+        except BaseException:
+            pool.release(key, reader, writer, False)
+            raise
+        # give the connection back to the pool
+        pool.release(key, reader, writer, reuse)
+        return status
+
+# handle the requests of one client of the local test server
+async def handle_client(reader, writer):
+    try:
+        while True:
+            # read the request line and the headers
+            request = await reader.readline()
+            if not request:
+                break
+            close = False
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                line = line.lower()
+                if line.startswith(b'connection:') and b'close' in line:
+                    close = True
+            # answer with a chunked body or a body of known length
+            path = request.split()[1]
+            body = b'<html>' + b'x' * 2000 + b'</html>'
+            if path.startswith(b'/chunked'):
+                writer.write(b'HTTP/1.1 200 OK\r\n' +
+                    b'Transfer-Encoding: chunked\r\n\r\n')
+                for start in range(0, len(body), 500):
+                    chunk = body[start:start + 500]
+                    writer.write(f'{len(chunk):x}\r\n'.encode() + chunk + b'\r\n')
+                writer.write(b'0\r\n\r\n')
+            else:
+                writer.write(b'HTTP/1.1 200 OK\r\n' +
+                    f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+            if close:
+                break
+    except ConnectionError:
+        pass
+    writer.close()
+
+# read the urls of a file one line at a time, skipping blank lines
+def read_urls(path):
+    with open(path) as file:
+        for line in file:
+            url = line.strip()
+            if url:
+                yield url
+
+# check one url, returning a result record whatever happens
+async def check_url(url, pool):
+    try:
+        async with asyncio.timeout(TIMEOUT):
+            status = await get_status(url, pool)
+        return {'url': url, 'status': status}
+    except Exception as e:
+        return {'url': url, 'error': repr(e)}
+
+# check the urls taken from a shared iterator until it is exhausted
+async def worker(urls, pool, output):
+    # taking the next url never awaits, so the workers never get the same one
+    for url in urls:
+        result = await check_url(url, pool)
+        # write the result as soon as it is known, one json object per line
+        output.write(json.dumps(result) + '\n')
+
+# check every url with at most max_in_flight requests at once
+async def check_stream(urls, output, resolver, max_in_flight=MAX_IN_FLIGHT):
+    # a fixed number of workers share the iterator, so a new request starts as soon
+    # as one finishes and no coroutine exists for a url that is not being checked
+    urls = iter(urls)
+    pool = ConnectionPool(resolver, max_per_host=max_in_flight)
+    try:
+        workers = [worker(urls, pool, output) for _ in range(max_in_flight)]
+        await asyncio.gather(*workers)
+    finally:
+        await pool.close()
+
+# generate the urls of pages on hosts, some of which do not exist
+def generate_urls(hosts, port, count):
+    for i in range(count):
+        yield f'http://{hosts[i % len(hosts)]}:{port}/page/{i}'
+
+# main coroutine
+async def main():
+    # check the urls of a file given on the command line, writing json lines to stdout
+    if len(sys.argv) > 1:
+        resolver = CachingResolver(SystemResolver())
+        await check_stream(read_urls(sys.argv[1]), sys.stdout, resolver)
+        return
+    # otherwise start a local server, no network needed
+    server = await asyncio.start_server(handle_client, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    # a stub dns server that takes 20 ms to answer, knowing four of the five hosts
+    hosts = [f'host{i}.test' for i in range(4)] + ['missing.test']
+    addresses = {host: ['127.0.0.1'] for host in hosts[:-1]}
+    # check the same urls with and without the cache
+    with open(os.devnull, 'w') as output:
+        for label, cached in (('no cache', False), ('cache', True)):
+            stub = StubResolver(addresses, delay=0.02)
+            resolver = CachingResolver(stub) if cached else stub
+            time_start = perf_counter()
+            await check_stream(generate_urls(hosts, port, 20000), output, resolver)
+            time_check = perf_counter() - time_start
+            print(f'{label:>8}: {stub.lookups} lookups, {time_check:.3f} seconds')
+        # the system resolver behind the cache, for a real host name
+        resolver = CachingResolver(SystemResolver())
+        await check_stream(generate_urls(['localhost'], port, 1000), output, resolver)
+        print(f'system resolver: localhost is {resolver.cache["localhost"][1]}')
+    # close the server
+    server.close()
+    await server.wait_closed()
+
+# record start time
+time_start = perf_counter()
+# start the asyncio event loop
+asyncio.run(main())
+# calculate duration
+time_duration = perf_counter() - time_start
+# report duration
+print(f'Took {time_duration:.3f} seconds', file=sys.stderr)
@@ -0,0 +1,547 @@
+# SuperFastPython.com
+# check the status of many webpages politely, within limits for each host
+import asyncio
+import heapq
+import json
+import os
+import socket
+import sys
+from collections import OrderedDict, defaultdict, deque
+from urllib.parse import urlsplit
+from time import perf_counter
+
+# bytes read at a time when skipping a response body
+READ_SIZE = 64 * 1024
+
+# most requests in flight at once
+MAX_IN_FLIGHT = 200
+
+# most requests in flight and requests started per second for one host
+PER_HOST_CONCURRENCY = 4
+PER_HOST_RATE = 10
+
+# requests started per second over all hosts, None for no limit
+GLOBAL_RATE = None
+
+# most urls read ahead and waiting in the queues of the hosts
+MAX_QUEUED = 10000
+
+# seconds allowed for one check
+TIMEOUT = 10
+
+# most idle connections kept open over all hosts
+MAX_IDLE = 100
+
+# resolver asking the system, getaddrinfo runs in the default thread pool
+class SystemResolver:
+    # return the addresses of a host name
+    async def resolve(self, host):
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        return [info[4][0] for info in infos]
+
+# resolver remembering the answers of another resolver
+class CachingResolver:
+    # wrap a resolver, keeping addresses for ttl seconds and failures for negative_ttl,
+    # for at most max_entries host names
+    def __init__(self, resolver, ttl=300, negative_ttl=30, max_entries=10000):
+        self.resolver = resolver
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        # host -> (expiry time, addresses or error), least recently stored first
+        self.cache = OrderedDict()
+        # host -> task of the lookup in progress
+        self.in_flight = {}
+
+    # return the addresses of a host name
+    async def resolve(self, host):
+        loop = asyncio.get_running_loop()
+        # answer from the cache while the entry is fresh
+        entry = self.cache.get(host)
+        if entry is not None:
+            if entry[0] > loop.time():
+                if isinstance(entry[1], Exception):
+                    raise entry[1].with_traceback(None)
+                return entry[1]
+            # forget the expired entry
+            del self.cache[host]
+        # join the lookup of the host in progress, or start it
+        task = self.in_flight.get(host)
+        if task is None:
+            task = asyncio.create_task(self.lookup(host))
+            self.in_flight[host] = task
+            # the lookup goes on if its callers give up, read its error anyway
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        # a caller that is cancelled does not cancel the lookup of the others
+        return await asyncio.shield(task)
+
+    # ask the wrapped resolver and remember its answer
+    async def lookup(self, host):
+        loop = asyncio.get_running_loop()
+        try:
+            addresses = await self.resolver.resolve(host)
+        except socket.gaierror as e:
+            # remember that the name does not resolve, for a shorter time
+            self.store(host, (loop.time() + self.negative_ttl, e))
+            raise
+        finally:
+            del self.in_flight[host]
+        self.store(host, (loop.time() + self.ttl, addresses))
+        return addresses
+
+    # remember an answer, forgetting the oldest ones over the limit
+    def store(self, host, entry):
+        self.cache.pop(host, None)
+        self.cache[host] = entry
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+
+# pool of open connections for each host
+class ConnectionPool:
+    # create an empty pool that opens at most max_per_host connections to a host and
+    # keeps at most max_idle idle ones, finding the address of a host with the resolver
+    def __init__(self, resolver, max_per_host=10, max_idle=MAX_IDLE):
+        self.resolver = resolver
+        self.max_per_host = max_per_host
+        self.max_idle = max_idle
+        # idle connections for each (scheme, host, port), oldest first
+        self.idle = {}
+        # idle connections of all hosts, least recently used first: writer -> key
+        self.lru = OrderedDict()
+        # limit on the connections in use for each (scheme, host, port), and the number
+        # of checks holding or waiting for a connection to it
+        self.limits = {}
+        self.users = {}
+        # number of connections opened
+        self.opened = 0
+
+    # borrow a connection to a host, reusing an idle one when possible
+    async def acquire(self, key):
+        # wait for the host to be below its limit
+        if key not in self.limits:
+            self.limits[key] = asyncio.Semaphore(self.max_per_host)
+        self.users[key] = self.users.get(key, 0) + 1
+        try:
+            await self.limits[key].acquire()
+        except BaseException:
+            self.forget(key)
+            raise
+        # take the most recently used idle connection still open
+        while key in self.idle:
+            reader, writer = self.take_idle(key, -1)
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        # open a new connection, giving back the slot if it fails
+        try:
+            reader, writer = await self.connect(*key)
+        except BaseException:
+            self.limits[key].release()
+            self.forget(key)
+            raise
+        self.opened += 1
+        return reader, writer, False
+
+    # open a connection to the first address of the host that answers
+    async def connect(self, scheme, host, port):
+        addresses = await self.resolver.resolve(host)
+        error = OSError(f'no addresses for {host}')
+        for address in addresses:
+            try:
+                # tls checks the certificate against the host name, not the address
+                if scheme == 'https':
+                    return await asyncio.open_connection(
+                        address, port, ssl=True, server_hostname=host)
+                return await asyncio.open_connection(address, port)
+            except OSError as e:
+                error = e
+        raise error
+
+    # give a connection back, keeping it open if it can be reused
+    def release(self, key, reader, writer, reuse):
+        if reuse:
+            self.idle.setdefault(key, []).append((reader, writer))
+            self.lru[writer] = key
+            # close the least recently used idle connection over the limit
+            if len(self.lru) > self.max_idle:
+                _, oldest = self.take_idle(next(iter(self.lru.values())), 0)
+                oldest.close()
+        else:
+            writer.close()
+        self.limits[key].release()
+        self.forget(key)
+
+    # take an idle connection of a host out of the pool, oldest at 0, newest at -1
+    def take_idle(self, key, index):
+        idle = self.idle[key]
+        reader, writer = idle.pop(index)
+        del self.lru[writer]
+        if not idle:
+            del self.idle[key]
+        return reader, writer
+
+    # forget the limit of a host once no check holds or waits for one of its connections
+    def forget(self, key):
+        self.users[key] -= 1
+        if not self.users[key]:
+            del self.users[key]
+            del self.limits[key]
+
+    # close all the idle connections
+    async def close(self):
+        writers = list(self.lru)
+        self.idle.clear()
+        self.lru.clear()
+        for writer in writers:
+            writer.close()
+        # wait for the connections to close, ignoring servers that already left
+        await asyncio.gather(*[writer.wait_closed() for writer in writers],
+            return_exceptions=True)
+
+# skip a number of bytes of the body
+async def skip_bytes(reader, size):
+    while size > 0:
+        data = await reader.read(min(size, READ_SIZE))
+        if not data:
+            raise asyncio.IncompleteReadError(b'', size)
+        size -= len(data)
+
+# read a whole response, return the status line and if the connection can be reused
+async def read_response(reader):
+    # read the status line, the server may have closed an idle connection
+    status = (await reader.readline()).decode().strip()
+    if not status:
+        raise ConnectionResetError('connection closed by the server')
+    # read the headers up to the blank line
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+    # the connection is kept unless the server asks to close it
+    reuse = status.startswith('HTTP/1.1') and headers.get('connection') != 'close'
+    # read the body, so the next response starts at the right place
+    code = status.split()[1] if len(status.split()) > 1 else ''
+    if code.startswith('1') or code in ('204', '304'):
+        # no body
+        pass
+    elif 'chunked' in headers.get('transfer-encoding', ''):
+        # chunks of a hexadecimal size, ending with an empty chunk and the trailers
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            await skip_bytes(reader, size + 2)
+    elif 'content-length' in headers:
+        await skip_bytes(reader, int(headers['content-length']))
+    else:
+        # the body ends when the server closes the connection
+        while await reader.read(READ_SIZE):
+            pass
+        reuse = False
+    return status, reuse
+
+# get the HTTP/S status of a webpage over a pooled connection
+async def get_status(url, pool):
+    # split the url into components
+    url_parsed = urlsplit(url)
+    port = url_parsed.port or (443 if url_parsed.scheme == 'https' else 80)
+    key = (url_parsed.scheme, url_parsed.hostname, port)
+    # build the GET request, keeping the connection open
+    path = url_parsed.path or '/'
+    if url_parsed.query:
+        path += '?' + url_parsed.query
+    query = f'GET {path} HTTP/1.1\r\n' + \
+        f'Host: {url_parsed.netloc}\r\n' + \
+        'Connection: keep-alive\r\n\r\n'
+    # try again on a new connection if an idle one was closed by the server
+    while True:
+        reader, writer, reused = await pool.acquire(key)
+        try:
+            # write query to socket
+            writer.write(query.encode())
+            # wait for the bytes to be written to the socket
+            await writer.drain()
+            # read the whole response
+            status, reuse = await read_response(reader)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pool.release(key, reader, writer, False)
+            if reused:
+                continue
+            raise
+        except BaseException:
+            pool.release(key, reader, writer, False)
+            raise
+        # give the connection back to the pool
+        pool.release(key, reader, writer, reuse)
+        return status
+
+# read the urls of a file one line at a time, skipping blank lines
+def read_urls(path):
+    with open(path) as file:
+        for line in file:
+            url = line.strip()
+            if url:
+                yield url
+
+# check one url, returning a result record whatever happens
+async def check_url(url, pool):
+    try:
+        async with asyncio.timeout(TIMEOUT):
+            status = await get_status(url, pool)
+        return {'url': url, 'status': status}
+    except Exception as e:
+        return {'url': url, 'error': repr(e)}
+
+
+# start the checks of urls so that no host gets more than its share
+class HostScheduler:
+    # create a scheduler with limits for each host and over all hosts
+    def __init__(self, per_host_concurrency=PER_HOST_CONCURRENCY,
+            per_host_rate=PER_HOST_RATE, global_rate=GLOBAL_RATE,
+            max_in_flight=MAX_IN_FLIGHT):
+        self.per_host_concurrency = per_host_concurrency
+        self.per_host_interval = 1 / per_host_rate
+        self.global_interval = 1 / global_rate if global_rate else 0
+        self.max_in_flight = max_in_flight
+        # urls waiting for each host
+        self.queues = defaultdict(deque)
+        self.queued = 0
+        # requests in flight for each host and in total
+        self.active = defaultdict(int)
+        self.in_flight = 0
+        # earliest time of the next request to each host and to any host
+        self.next_start = {}
+        self.global_next_start = 0
+        # (time, host) of the next start times to forget once passed, earliest first
+        self.expiring = []
+        # hosts that may start a request now, taken in turn
+        self.ready = deque()
+        # (time, host) of the hosts waiting for their rate limit, earliest first
+        self.sleeping = []
+        # hosts in ready or sleeping, a host waiting on its concurrency is in neither
+        self.placed = set()
+        # set when a request finishes
+        self.wakeup = asyncio.Event()
+
+    # add a url to the queue of its host
+    def add(self, url):
+        host = urlsplit(url).netloc.lower()
+        self.queues[host].append(url)
+        self.queued += 1
+        self.place(host)
+
+    # put a host where it belongs now: ready, sleeping or nowhere
+    def place(self, host):
+        # nothing to do for a host already placed, with no url or at its concurrency
+        if host in self.placed or not self.queues.get(host):
+            return
+        if self.active.get(host, 0) >= self.per_host_concurrency:
+            return
+        self.placed.add(host)
+        start = self.next_start.get(host, 0)
+        if start > asyncio.get_running_loop().time():
+            heapq.heappush(self.sleeping, (start, host))
+        else:
+            self.ready.append(host)
+
+    # forget the next start time of the hosts with nothing left, once it has passed
+    def expire(self, now):
+        while self.expiring and self.expiring[0][0] <= now:
+            _, host = heapq.heappop(self.expiring)
+            if host in self.next_start and host not in self.queues and \
+                    host not in self.active and self.next_start[host] <= now:
+                del self.next_start[host]
+
+    # start the next url of a host
+    def start(self, host, check, results):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        url = self.queues[host].popleft()
+        self.queued -= 1
+        if not self.queues[host]:
+            del self.queues[host]
+        # space the requests to this host and to all hosts
+        self.next_start[host] = max(now, self.next_start.get(host, 0)) + \
+            self.per_host_interval
+        heapq.heappush(self.expiring, (self.next_start[host], host))
+        self.global_next_start = max(now, self.global_next_start) + \
+            self.global_interval
+        self.active[host] += 1
+        self.in_flight += 1
+        # run the check, then let the host start another one
+        task = asyncio.create_task(check(url))
+        task.add_done_callback(lambda task: self.finish(host, task, results))
+        # the host goes to the back of the line
+        self.placed.discard(host)
+        self.place(host)
+
+    # record a finished check and wake up the scheduler
+    def finish(self, host, task, results):
+        self.active[host] -= 1
+        if not self.active[host]:
+            del self.active[host]
+            # forget the host once its next start time has passed, unless it gets urls
+            if host not in self.queues:
+                heapq.heappush(self.expiring, (self.next_start[host], host))
+        self.in_flight -= 1
+        results.append(task.result())
+        self.place(host)
+        self.wakeup.set()
+
+    # check every url, calling report with each result as soon as it is known
+    async def run(self, urls, check, report):
+        loop = asyncio.get_running_loop()
+        urls = iter(urls)
+        exhausted = False
+        results = []
+        while True:
+            # read urls ahead into the queues of their hosts, up to a limit
+            while not exhausted and self.queued < MAX_QUEUED:
+                url = next(urls, None)
+                if url is None:
+                    exhausted = True
+                else:
+                    self.add(url)
+            # report the results of the finished checks
+            for result in results:
+                report(result)
+            results.clear()
+            # wake up the hosts whose rate limit has passed, forget the idle hosts
+            now = loop.time()
+            self.expire(now)
+            while self.sleeping and self.sleeping[0][0] <= now:
+                self.ready.append(heapq.heappop(self.sleeping)[1])
+            # start requests on the ready hosts in turn, within the global limits
+            while self.ready and self.in_flight < self.max_in_flight and \
+                    self.global_next_start <= now:
+                self.start(self.ready.popleft(), check, results)
+            # stop once every url has been checked
+            if exhausted and not self.queued and not self.in_flight:
+                break
+            # wait for a request to finish or for the next start allowed by a limit
+            delay = None
+            if self.ready and self.in_flight < self.max_in_flight:
+                delay = self.global_next_start - now
+            elif self.sleeping:
+                delay = max(self.sleeping[0][0], self.global_next_start) - now
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        for result in results:
+            report(result)
+
+# check every url politely, writing a json line for each result
+async def check_polite(urls, output, resolver, **limits):
+    scheduler = HostScheduler(**limits)
+    pool = ConnectionPool(resolver, max_per_host=scheduler.per_host_concurrency)
+    try:
+        await scheduler.run(urls, lambda url: check_url(url, pool),
+            lambda result: output.write(json.dumps(result) + '\n'))
+    finally:
+        await pool.close()
+
+# check every url as fast as possible, as the streaming example does
+async def check_stream(urls, output, resolver, max_in_flight=MAX_IN_FLIGHT):
+    urls = iter(urls)
+    pool = ConnectionPool(resolver, max_per_host=max_in_flight)
+    # check the urls taken from the shared iterator until it is exhausted
+    async def worker():
+        for url in urls:
+            result = await check_url(url, pool)
+            output.write(json.dumps(result) + '\n')
+    try:
+        await asyncio.gather(*[worker() for _ in range(max_in_flight)])
+    finally:
+        await pool.close()
+
+# requests seen by each local test server:
+# port -> [in flight, most in flight, start times]
+SERVER_STATS = defaultdict(lambda: [0, 0, []])
+
+# handle the requests of one client of a local test server, taking 50 ms for each
+async def handle_client(reader, writer):
+    stats = SERVER_STATS[writer.get_extra_info('sockname')[1]]
+    try:
+        while True:
+            # read the request line and the headers
+            request = await reader.readline()
+            if not request:
+                break
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            # count the requests in flight and record when they started
+            stats[0] += 1
+            stats[1] = max(stats[1], stats[0])
+            stats[2].append(perf_counter())
+            await asyncio.sleep(0.05)
+            stats[0] -= 1
+            # answer with a small page
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+            await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
+
+# most requests started within any one second
+def peak_rate(times):
+    times = sorted(times)
+    first = 0
+    peak = 0
+    for last, time_last in enumerate(times):
+        while time_last - times[first] >= 1:
+            first += 1
+        peak = max(peak, last - first + 1)
+    return peak
+
+# main coroutine
+async def main():
+    resolver = CachingResolver(SystemResolver())
+    # check the urls of a file given on the command line, writing json lines to stdout
+    if len(sys.argv) > 1:
+        await check_polite(read_urls(sys.argv[1]), sys.stdout, resolver)
+        return
+    # otherwise start local servers standing for different hosts, no network needed
+    servers = [await asyncio.start_server(handle_client, '127.0.0.1', 0)
+        for _ in range(4)]
+    ports = [server.sockets[0].getsockname()[1] for server in servers]
+    # half of the urls are on the first host, the rest spread over the others
+    urls = [f'http://127.0.0.1:{ports[0 if i % 2 else 1 + i % 3]}/page/{i}'
+        for i in range(400)]
+    with open(os.devnull, 'w') as output:
+        for label, check, limits in (
+                ('no limits', check_stream, {}),
+                ('polite', check_polite, {'per_host_concurrency': 2,
+                    'per_host_rate': 50, 'global_rate': 120})):
+            SERVER_STATS.clear()
+            time_start = perf_counter()
+            await check(urls, output, resolver, **limits)
+            time_check = perf_counter() - time_start
+            # report what each host has seen
+            print(f'{label}: {len(urls)} checks in {time_check:.3f} seconds, '
+                f'{len(urls) / time_check:.0f} checks/sec')
+            for port in ports:
+                in_flight, most_in_flight, times = SERVER_STATS[port]
+                print(f'    host {port}: {len(times)} requests, '
+                    f'at most {most_in_flight} at once, '
+                    f'at most {peak_rate(times)} in one second')
+    # close the servers
+    for server in servers:
+        server.close()
+        await server.wait_closed()
+
+# record start time
+time_start = perf_counter()
+# start the asyncio event loop
+asyncio.run(main())
+# calculate duration
+time_duration = perf_counter() - time_start
+# report duration
+print(f'Took {time_duration:.3f} seconds', file=sys.stderr)
@@ -0,0 +1,181 @@
+# SuperFastPython.com
+# check the status of many webpages with HEAD requests, reading only the headers
+import asyncio
+from collections import Counter
+from urllib.parse import urlsplit
+from time import perf_counter
+
+# statuses of a server that does not allow HEAD, ask again with a ranged GET
+HEAD_NOT_ALLOWED = ('405', '501')
+
+# open a connection to the host of a url
+async def open_connection(url_parsed):
+    if url_parsed.scheme == 'https':
+        return await asyncio.open_connection(
+            url_parsed.hostname, url_parsed.port or 443, ssl=True)
+    return await asyncio.open_connection(url_parsed.hostname, url_parsed.port or 80)
+
+# send a request for a url
+async def send_request(writer, method, url_parsed, headers=''):
+    path = url_parsed.path or '/'
+    if url_parsed.query:
+        path += '?' + url_parsed.query
+    query = f'{method} {path} HTTP/1.1\r\n' + \
+        f'Host: {url_parsed.netloc}\r\n' + headers + '\r\n'
+    # write query to socket
+    writer.write(query.encode())
+    # wait for the bytes to be written to the socket
+    await writer.drain()
+
+# read the status line and the headers of a response, none of the body
+async def read_head(reader):
+    status = (await reader.readline()).decode().strip()
+    if not status:
+        raise ConnectionResetError('connection closed by the server')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+    return status, headers
+
+# get the HTTP/S status of a webpage as the other examples do, GET and close at once
+async def get_status(url):
+    # split the url into components
+    url_parsed = urlsplit(url)
+    # open the connection
+    reader, writer = await open_connection(url_parsed)
+    # send GET request
+    await send_request(writer, 'GET', url_parsed)
+    # read the single line response
+    response = await reader.readline()
+    # close the connection
+    writer.close()
+    # decode and strip white space
+    return response.decode().strip()
+
+# probe the HTTP/S status of a webpage, the server sends the headers but no page
+async def probe_status(url):
+    # split the url into components
+    url_parsed = urlsplit(url)
+    # open the connection
+    reader, writer = await open_connection(url_parsed)
+    try:
+        # ask for the headers only
+        await send_request(writer, 'HEAD', url_parsed)
+        status, headers = await read_head(reader)
+        code = status.split()[1] if len(status.split()) > 1 else ''
+        if code in HEAD_NOT_ALLOWED:
+            # a HEAD response has no body, so the connection can be used again
+            # unless the server closes it
+            if headers.get('connection') == 'close' or \
+                    not status.startswith('HTTP/1.1'):
+                writer.close()
+                await writer.wait_closed()
+                reader, writer = await open_connection(url_parsed)
+            # ask for the first byte of the page, the answer is 206 Partial Content
+            # or the whole page from a server that ignores ranges
+            await send_request(writer, 'GET', url_parsed,
+                'Range: bytes=0-0\r\nConnection: close\r\n')
+            status, headers = await read_head(reader)
+    finally:
+        # close the connection without reading any body, and wait for it to close
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+    return status
+
+# bytes received and sent by the local test server
+SERVER_BYTES = Counter()
+
+# size of each page of the local test server
+PAGE_SIZE = 100 * 1024
+
+# handle the requests of one client of the local test server
+async def handle_client(reader, writer):
+    try:
+        while True:
+            # read the request line and the headers
+            request = await reader.readline()
+            if not request:
+                break
+            SERVER_BYTES['received'] += len(request)
+            ranged = False
+            close = False
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                SERVER_BYTES['received'] += len(line)
+                line = line.lower()
+                ranged = ranged or line.startswith(b'range: bytes=0-0')
+                close = close or (line.startswith(b'connection:') and b'close' in line)
+            SERVER_BYTES['received'] += len(line)
+            method, path = request.split()[:2]
+            # pages under /nohead/ do not allow HEAD, as some servers do
+            if method == b'HEAD' and path.startswith(b'/nohead/'):
+                head = b'HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\n\r\n'
+                body = b''
+            elif ranged:
+                head = b'HTTP/1.1 206 Partial Content\r\nContent-Length: 1\r\n' + \
+                    f'Content-Range: bytes 0-0/{PAGE_SIZE}\r\n\r\n'.encode()
+                body = b'x'
+            else:
+                head = b'HTTP/1.1 200 OK\r\n' + \
+                    f'Content-Length: {PAGE_SIZE}\r\n\r\n'.encode()
+                body = b'' if method == b'HEAD' else b'x' * PAGE_SIZE
+            # send the response a piece at a time, counting what the client let through
+            data = head + body
+            for start in range(0, len(data), 16 * 1024):
+                writer.write(data[start:start + 16 * 1024])
+                await writer.drain()
+                SERVER_BYTES['sent'] += len(data[start:start + 16 * 1024])
+            if close:
+                break
+    except ConnectionError:
+        pass
+    writer.close()
+
+# check all urls, at most limit at a time
+async def check_all(urls, check, limit):
+    semaphore = asyncio.Semaphore(limit)
+    # check one url once a slot is free
+    async def check_one(url):
+        async with semaphore:
+            return await check(url)
+    return await asyncio.gather(*[check_one(url) for url in urls])
+
+# main coroutine
+async def main():
+    # start a local server, no network needed
+    server = await asyncio.start_server(handle_client, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    # a page in four on a path that does not allow HEAD
+    urls = [f'http://127.0.0.1:{port}/{"nohead" if i % 4 == 0 else "page"}/{i}'
+        for i in range(1000)]
+    for label, check in (('GET and close', get_status), ('probe', probe_status)):
+        SERVER_BYTES.clear()
+        time_start = perf_counter()
+        results = await check_all(urls, check, 50)
+        time_check = perf_counter() - time_start
+        # let the server finish with the connections closed by the client
+        await asyncio.sleep(0.5)
+        # report the bytes for each check and the statuses seen
+        print(f'{label}: {len(urls)} checks in {time_check:.3f} seconds, '
+            f'{SERVER_BYTES["received"] / len(urls):.0f} bytes sent and '
+            f'{SERVER_BYTES["sent"] / len(urls):.0f} bytes received per check')
+        for status, count in sorted(Counter(results).items()):
+            print(f'    {count} x {status}')
+    # close the server
+    server.close()
+    await server.wait_closed()
+
+# record start time
+time_start = perf_counter()
+# start the asyncio event loop
+asyncio.run(main())
+# calculate duration
+time_duration = perf_counter() - time_start
+# report duration
+print(f'Took {time_duration:.3f} seconds')
@@ -9,20 +9,41 @@ async def write_message(writer, msg_bytes):
     # wait for the buffer to empty
     await writer.drain()
 
-# send a message to all connected users
-async def broadcast_message(message):
+# send a message to all users in a room
+async def broadcast_message(message, room):
     # report locally
-    print(f'Broadcast: {message.strip()}')
+    print(f'Broadcast #{room}: {message.strip()}')
     # convert to bytes
     msg_bytes = message.encode()
-    # enumerate all users and broadcast the message
-    global ALL_USERS
+    # enumerate the users of the room and broadcast the message
+    global ALL_USERS, ROOMS
     # create a task for each write to client
     tasks = [asyncio.create_task(
-        write_message(w, msg_bytes)) for _,(_,w) in
-            ALL_USERS.items()]
+        write_message(ALL_USERS[name][1], msg_bytes))
+            for name in ROOMS.get(room, ())]
     # wait for all writes to complete
-    _ = await asyncio.wait(tasks)
+    if tasks:
+        _ = await asyncio.wait(tasks)
+
+# move a user to another room
+async def change_room(name, room):
+    global ROOMS, USER_ROOMS
+    # nothing to do if the user is already there
+    old_room = USER_ROOMS[name]
+    if room == old_room:
+        return
+    # leave the current room
+    ROOMS[old_room].discard(name)
+    # forget empty rooms
+    if not ROOMS[old_room]:
+        del ROOMS[old_room]
+    await broadcast_message(
+        f'{name} has left #{old_room}\n', old_room)
+    # enter the new room
+    ROOMS.setdefault(room, set()).add(name)
+    USER_ROOMS[name] = room
+    await broadcast_message(
+        f'{name} has joined #{room}\n', room)
 
 # connect a user
 async def connect_user(reader, writer):
@@ -35,14 +56,19 @@ async def connect_user(reader, writer):
     # convert name to string
     name = name_bytes.decode().strip()
     # store the user details
-    global ALL_USERS
+    global ALL_USERS, ROOMS, USER_ROOMS
     ALL_USERS[name] = (reader, writer)
+    # put the user in the default room
+    ROOMS.setdefault(DEFAULT_ROOM, set()).add(name)
+    USER_ROOMS[name] = DEFAULT_ROOM
     # announce the user
     await broadcast_message(
-        f'{name} has connected\n')
+        f'{name} has connected\n', DEFAULT_ROOM)
     # welcome message
     welcome = f'Welcome {name}. ' + \
-        'Send QUIT to disconnect.\n'
+        'Send JOIN <room> to change room, ' + \
+        'LEAVE to return to the lobby ' + \
+        'and QUIT to disconnect.\n'
     writer.write(welcome.encode())
     await writer.drain()
     return name
@@ -53,11 +79,16 @@ async def disconnect_user(name, writer):
     writer.close()
     await writer.wait_closed()
     # remove from the dict of all users
-    global ALL_USERS
+    global ALL_USERS, ROOMS, USER_ROOMS
     del ALL_USERS[name]
+    # remove from the room
+    room = USER_ROOMS.pop(name)
+    ROOMS[room].discard(name)
+    if not ROOMS[room]:
+        del ROOMS[room]
     # broadcast the user has left
     await broadcast_message(
-        f'{name} has disconnected\n')
+        f'{name} has disconnected\n', room)
 
 # handle a chat client
 async def handle_chat_client(reader, writer):
@@ -74,8 +105,16 @@ async def handle_chat_client(reader, writer):
             # check for exit
             if line == 'QUIT':
                 break
-            # broadcast message
-            await broadcast_message(f'{name}: {line}\n')
+            # check for a change of room
+            if line.startswith('JOIN ') and line[5:].strip():
+                await change_room(name, line[5:].strip())
+                continue
+            if line == 'LEAVE':
+                await change_room(name, DEFAULT_ROOM)
+                continue
+            # broadcast message to the room of the user
+            await broadcast_message(
+                f'{name}: {line}\n', USER_ROOMS[name])
     finally:
         # disconnect the user
         await disconnect_user(name, writer)
@@ -97,5 +136,11 @@ async def main():
 
 # dict of all current users
 ALL_USERS = {}
+# dict of room name to the set of user names in it
+ROOMS = {}
+# dict of user name to the room they are in
+USER_ROOMS = {}
+# room for new users
+DEFAULT_ROOM = 'lobby'
 # start the asyncio event loop
 asyncio.run(main())